@@ -1,33 +1,57 @@
 # -*- coding: utf-8 -*-
 import fnmatch
 import hashlib
+import io
+import json
+import math
 import pathlib
 import re
 import secrets
-from os import scandir
-from sys import stderr
+import shutil
+import sqlite3
+import struct
+import zlib
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import groupby
+from os import fstat, scandir
+from os.path import normcase
+from queue import Queue
+from sys import stderr, stdout
+from threading import Lock, Thread
 from time import strftime
-from typing import Dict, List, Optional, Pattern, Union
+from typing import BinaryIO, Callable, Dict, Iterable, List, Optional, Pattern, Sequence, Set, TextIO, Tuple, Union
+
+import Profiler
 
 
 class FileInfo:
-    __slots__ = ["__filePath", "__checksum", "__duplicate", "__id"]
+    __slots__ = ["__filePath", "__checksum", "__duplicate", "__id", "__group"]
 
-    __filePath: pathlib.Path
+    __filePath: Union[pathlib.Path, str]
     __checksum: str
     __id: int
     __duplicate: "FileInfo"
+    __group: Optional["DuplicateGroup"]
 
     # noinspection PyShadowingBuiltins
-    def __init__( self, filePath: pathlib.Path, checksum: str, id: int ):
+    def __init__( self, filePath: Union[pathlib.Path, str], checksum: str, id: int ):
         self.__filePath = filePath
         self.__checksum = checksum
         self.__id = id
         self.__duplicate = None
+        self.__group = None
 
     @property
     def filePath( self ):
-        return self.__filePath
+        filePath = self.__filePath
+        if isinstance( filePath, str ):
+            # путь из индексного файла преобразуется при первом обращении
+            filePath = pathlib.Path( filePath )
+            self.__filePath = filePath
+
+        return filePath
 
     @property
     def checksum( self ):
@@ -45,10 +69,24 @@ class FileInfo:
     def duplicate( self, other: "FileInfo" ):
         self.__duplicate = other
 
+    def addDuplicate( self, other: "FileInfo" ):
+        # группа создаётся только у первого файла цепочки и только при появлении дубликата
+        group = self.__group
+        if group is None:
+            group = DuplicateGroup( self )
+            self.__group = group
+
+        group.append( other )
+
     def findBestMatch( self, filePath: pathlib.Path ):
         if self.duplicate is None:
             return self
 
+        group = self.__group
+        if group is not None:
+            match = group.findByName( filePath.name )
+            return match if match is not None else self
+
         # есть файлы с одинаковой чек-суммой, ищем первый совпадающий по имени
         fileName = filePath.name.lower()
 
@@ -62,6 +100,44 @@ class FileInfo:
         return self
 
 
+class DuplicateGroup:
+    """Files with identical checksum: chain tail for appending and index by lowercase file name."""
+    __slots__ = ["__head", "__tail", "__names"]
+
+    __names: Optional[Dict[str, FileInfo]]
+
+    def __init__( self, head: FileInfo ):
+        tail = head
+        while tail.duplicate is not None:
+            tail = tail.duplicate
+
+        self.__head = head
+        self.__tail = tail
+        self.__names = None
+
+    def append( self, fileInfo: FileInfo ):
+        self.__tail.duplicate = fileInfo
+        self.__tail = fileInfo
+
+        names = self.__names
+        if names is not None:
+            names.setdefault( fileInfo.filePath.name.lower(), fileInfo )
+
+    def findByName( self, fileName: str ):
+        names = self.__names
+        if names is None:
+            # индекс строится при первом поиске, пока база загружается имена не разбираются
+            names = dict()
+            f = self.__head
+            while f is not None:
+                names.setdefault( f.filePath.name.lower(), f )
+                f = f.duplicate
+
+            self.__names = names
+
+        return names.get( fileName.lower(), None )
+
+
 class FileDb:
     __hashIndex: Dict[str, FileInfo]
     __algorithms: List[str]
@@ -76,9 +152,18 @@ class FileDb:
         return self.__algorithms
 
     def hasAlgorithm( self, algorithm: str ):
-        return algorithm in self.__algorithms
+        return algorithm in self.algorithms
 
-    def addFile( self, filePath: pathlib.Path, checksum: str ):
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.close()
+
+    def close( self ):
+        pass
+
+    def addFile( self, filePath: Union[pathlib.Path, str], checksum: str ):
         algorithm = detectChecksumAlgorithm( checksum )
         if algorithm is None:
             raise ValueError( 'Unknown checksum type' )
@@ -91,38 +176,23 @@ class FileDb:
         if prevInfo is None:
             self.__hashIndex[checksum] = fileInfo
         else:
-            while prevInfo.duplicate is not None:
-                prevInfo = prevInfo.duplicate
-
-            prevInfo.duplicate = fileInfo
+            prevInfo.addDuplicate( fileInfo )
 
         self.__nextId += 1
 
     def addChecksumFile( self, basePath: Optional[pathlib.Path], fileName: pathlib.Path ):
+        prefix = indexPathPrefix( basePath )
         with ChecksumFileReader( fileName ) as reader:
-            for fp, c in reader:
-                if basePath is not None:
-                    fp = basePath.joinpath( fp )
-
-                self.addFile( fp, c )
+            for batch in reader.readBatches():
+                for n, c in batch:
+                    self.addFile( prefix + n, c )
 
     def addIndexedTree( self, basePath: pathlib.Path, relativePath: pathlib.Path = None ):
         if relativePath is None:
             relativePath = pathlib.Path()
-        self.__addIndexedTree( basePath, relativePath )
 
-    def __addIndexedTree( self, basePath: pathlib.Path, relativePath: pathlib.Path ):
-        folderPath = basePath.joinpath( relativePath )
-        for indexFileName in ('Checksums.sha2', 'Checksums.sha1'):
-            indexFilePath = folderPath.joinpath( indexFileName )
-            if indexFilePath.exists():
-                self.addChecksumFile( relativePath, indexFilePath )
-                return
-
-        with scandir( folderPath ) as it:
-            for fileEntry in it:
-                if fileEntry.is_dir():
-                    self.__addIndexedTree( basePath, relativePath.joinpath( fileEntry.name ) )
+        for folderPath, indexFilePath in iterateIndexFiles( basePath, relativePath ):
+            self.addChecksumFile( folderPath, indexFilePath )
 
     def get( self, checksum: str ):
         return self.__hashIndex.get( checksum, None )
@@ -134,6 +204,14 @@ class FileDb:
 
         return fileInfo
 
+    def findFileByChecksums( self, filePath: pathlib.Path, checksums: Dict[str, str] ):
+        for algorithm in self.algorithms:
+            fileInfo = self.get( checksums[algorithm] )
+            if fileInfo is not None:
+                return fileInfo.findBestMatch( filePath )
+
+        return None
+
     def __findFileInfoChain( self, filePath: pathlib.Path ):
         for algorithm in self.algorithms:
             fileInfo = self.get( calculateChecksum( filePath, algorithm ) )
@@ -146,6 +224,359 @@ class FileDb:
         return self.__hashIndex.items()
 
 
+class SqliteFileDb( FileDb ):
+    __algorithms: List[str]
+
+    def __init__( self, dbFilePath: pathlib.Path ):
+        super().__init__()
+        self.__algorithms = []
+        self.__directIndexId = None
+        self.__connection = sqlite3.connect( str( dbFilePath ) )
+        try:
+            self.__initSchema()
+        except Exception:
+            self.__connection.close()
+            raise
+
+    def __initSchema( self ):
+        c = self.__connection
+        c.execute( 'PRAGMA journal_mode = WAL' )
+        c.execute( 'PRAGMA synchronous = NORMAL' )
+        with c:
+            c.execute( 'CREATE TABLE IF NOT EXISTS indexFiles ( id INTEGER PRIMARY KEY, path TEXT NOT NULL, '
+                       'prefix TEXT NOT NULL, mtime INTEGER NOT NULL, size INTEGER NOT NULL, '
+                       'algorithms TEXT NOT NULL, UNIQUE ( path, prefix ) )' )
+            c.execute( 'CREATE TABLE IF NOT EXISTS entries ( id INTEGER PRIMARY KEY, '
+                       'indexFile INTEGER NOT NULL, checksum TEXT NOT NULL, path TEXT NOT NULL )' )
+            c.execute( 'CREATE INDEX IF NOT EXISTS entriesChecksum ON entries ( checksum )' )
+            c.execute( 'CREATE INDEX IF NOT EXISTS entriesIndexFile ON entries ( indexFile )' )
+
+        # индексные файлы, загруженные в текущем сеансе
+        c.execute( 'CREATE TEMP TABLE activeIndexFiles ( id INTEGER PRIMARY KEY )' )
+
+    def close( self ):
+        connection = self.__connection
+        if connection is not None:
+            self.__connection = None
+            connection.close()
+
+    @property
+    def algorithms( self ):
+        return self.__algorithms
+
+    def addFile( self, filePath: pathlib.Path, checksum: str ):
+        algorithm = detectChecksumAlgorithm( checksum )
+        if algorithm is None:
+            raise ValueError( 'Unknown checksum type' )
+
+        with self.__connection as c:
+            indexId = self.__getDirectIndexId()
+            c.execute( 'INSERT INTO entries ( indexFile, checksum, path ) VALUES ( ?, ?, ? )',
+                       (indexId, checksum, filePath.as_posix()) )
+
+        self.__addAlgorithms( (algorithm,) )
+
+    def __getDirectIndexId( self ):
+        # файлы, добавленные без индексного файла, хранятся только в течение сеанса
+        if self.__directIndexId is None:
+            c = self.__connection
+            self.__directIndexId = self.__replaceIndexFile( '', '' )
+            c.execute( 'INSERT INTO activeIndexFiles ( id ) VALUES ( ? )', (self.__directIndexId,) )
+
+        return self.__directIndexId
+
+    def addChecksumFile( self, basePath: Optional[pathlib.Path], fileName: pathlib.Path ):
+        c = self.__connection
+        prefix = '' if basePath is None else basePath.as_posix()
+        indexPath = str( fileName.resolve() )
+        s = fileName.stat()
+
+        row = c.execute( 'SELECT id, mtime, size, algorithms FROM indexFiles WHERE path = ? AND prefix = ?',
+                         (indexPath, prefix) ).fetchone()
+        if row is not None and row[1] == s.st_mtime_ns and row[2] == s.st_size:
+            indexId = row[0]
+            algorithms = row[3].split( ',' ) if row[3] != '' else []
+        else:
+            with c:
+                indexId = self.__replaceIndexFile( indexPath, prefix )
+                algorithms = []
+                c.executemany( 'INSERT INTO entries ( indexFile, checksum, path ) VALUES ( ?, ?, ? )',
+                               self.__readChecksumFile( indexId, basePath, fileName, algorithms ) )
+                c.execute( 'UPDATE indexFiles SET mtime = ?, size = ?, algorithms = ? WHERE id = ?',
+                           (s.st_mtime_ns, s.st_size, ','.join( algorithms ), indexId) )
+
+        c.execute( 'INSERT OR IGNORE INTO activeIndexFiles ( id ) VALUES ( ? )', (indexId,) )
+        self.__addAlgorithms( algorithms )
+
+    def __replaceIndexFile( self, indexPath: str, prefix: str ):
+        c = self.__connection
+        row = c.execute( 'SELECT id FROM indexFiles WHERE path = ? AND prefix = ?', (indexPath, prefix) ).fetchone()
+        if row is not None:
+            c.execute( 'DELETE FROM entries WHERE indexFile = ?', (row[0],) )
+            return row[0]
+
+        cursor = c.execute( "INSERT INTO indexFiles ( path, prefix, mtime, size, algorithms ) "
+                            "VALUES ( ?, ?, -1, -1, '' )", (indexPath, prefix) )
+        return cursor.lastrowid
+
+    @staticmethod
+    def __readChecksumFile( indexId: int, basePath: Optional[pathlib.Path], fileName: pathlib.Path,
+                            algorithms: List[str] ):
+        prefix = indexPathPrefix( basePath )
+        with ChecksumFileReader( fileName ) as reader:
+            for batch in reader.readBatches():
+                for n, c in batch:
+                    algorithm = detectChecksumAlgorithm( c )
+                    if algorithm is None:
+                        raise ValueError( 'Unknown checksum type' )
+
+                    if algorithm not in algorithms:
+                        algorithms.append( algorithm )
+
+                    yield indexId, c, pathlib.PurePosixPath( prefix + n ).as_posix()
+
+    def __addAlgorithms( self, algorithms: Iterable[str] ):
+        for algorithm in algorithms:
+            if algorithm not in self.__algorithms:
+                self.__algorithms.append( algorithm )
+
+    def get( self, checksum: str ):
+        rows = self.__connection.execute(
+            'SELECT e.id, e.path FROM entries e JOIN activeIndexFiles a ON a.id = e.indexFile '
+            'WHERE e.checksum = ? ORDER BY e.id', (checksum,) ).fetchall()
+        return self.__makeChain( checksum, rows )
+
+    def entries( self ):
+        cursor = self.__connection.execute(
+            'SELECT e.checksum, e.id, e.path FROM entries e JOIN activeIndexFiles a ON a.id = e.indexFile '
+            'ORDER BY e.checksum, e.id' )
+        for checksum, rows in groupby( cursor, key = lambda x: x[0] ):
+            yield checksum, self.__makeChain( checksum, [r[1:] for r in rows] )
+
+    @staticmethod
+    def __makeChain( checksum: str, rows: List[Tuple[int, str]] ):
+        first = None
+        for fileId, path in rows:
+            fileInfo = FileInfo( pathlib.Path( path ), checksum, fileId )
+            if first is None:
+                first = fileInfo
+            else:
+                first.addDuplicate( fileInfo )
+
+        return first
+
+
+IndexFileState = Tuple[str, int, int]
+
+
+class BloomFilter:
+    __bits: bytearray
+
+    # заголовок файла: сигнатура, версия, число хеш-функций, размер в битах, размеры списков
+    # алгоритмов и покрываемых индексных файлов (версия 2)
+    __magic = b'PABF'
+    __headerV1 = struct.Struct( '<4sBBQH' )
+    __header = struct.Struct( '<4sBBQHI' )
+
+    def __init__( self, *, bitCount: int, hashCount: int, algorithms: Iterable[str] = (),
+                  bits: Optional[bytearray] = None, sources: Iterable[IndexFileState] = () ):
+        self.__bitCount = bitCount
+        self.__hashCount = hashCount
+        self.__algorithms = list( algorithms )
+        self.__bits = bits if bits is not None else bytearray( (bitCount + 7) // 8 )
+        self.__sources = [tuple( s ) for s in sources]
+
+    @classmethod
+    def create( cls, capacity: int, falsePositiveRate: float = 0.001, sources: Iterable[IndexFileState] = () ):
+        capacity = max( capacity, 1 )
+        bitCount = max( int( -capacity * math.log( falsePositiveRate ) / (math.log( 2 ) ** 2) ), 64 )
+        hashCount = max( int( round( bitCount / capacity * math.log( 2 ) ) ), 1 )
+        return cls( bitCount = bitCount, hashCount = hashCount, sources = sources )
+
+    @classmethod
+    def load( cls, filePath: pathlib.Path ):
+        with filePath.open( mode = 'rb' ) as file:
+            header = file.read( cls.__headerV1.size )
+            if len( header ) != cls.__headerV1.size:
+                raise ValueError( f'{filePath}: invalid filter file' )
+
+            magic, version, hashCount, bitCount, algorithmsSize = cls.__headerV1.unpack( header )
+            if magic != cls.__magic or version not in (1, 2):
+                raise ValueError( f'{filePath}: invalid filter file' )
+
+            sourcesSize = 0
+            if version == 2:
+                sourcesSize, = struct.unpack( '<I', file.read( 4 ) )
+
+            algorithms = file.read( algorithmsSize ).decode( 'ascii' )
+            sources = json.loads( file.read( sourcesSize ).decode( 'utf-8' ) ) if sourcesSize > 0 else ()
+            bits = bytearray( file.read() )
+            if len( bits ) != (bitCount + 7) // 8:
+                raise ValueError( f'{filePath}: invalid filter file' )
+
+        return cls( bitCount = bitCount, hashCount = hashCount,
+                    algorithms = algorithms.split( ',' ) if algorithms != '' else (), bits = bits,
+                    sources = sources )
+
+    def save( self, filePath: pathlib.Path ):
+        algorithms = ','.join( self.__algorithms ).encode( 'ascii' )
+        sources = json.dumps( self.__sources, ensure_ascii = False ).encode( 'utf-8' ) if self.__sources else b''
+        tempFilePath = filePath.with_name( filePath.stem + '.tmp' + filePath.suffix )
+        try:
+            with tempFilePath.open( mode = 'wb' ) as file:
+                file.write( self.__header.pack( self.__magic, 2, self.__hashCount, self.__bitCount,
+                                                len( algorithms ), len( sources ) ) )
+                file.write( algorithms )
+                file.write( sources )
+                file.write( self.__bits )
+
+            tempFilePath.replace( filePath )
+        except BaseException:
+            try:
+                tempFilePath.unlink()
+            except OSError:
+                pass
+            raise
+
+    @property
+    def algorithms( self ):
+        return self.__algorithms
+
+    @property
+    def sources( self ):
+        """Index files the filter was built from: resolved path, size and modification time."""
+        return self.__sources
+
+    def add( self, checksum: str ):
+        algorithm = detectChecksumAlgorithm( checksum )
+        if algorithm not in self.__algorithms:
+            self.__algorithms.append( algorithm )
+
+        bits = self.__bits
+        for p in self.__positions( checksum ):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__( self, checksum: str ):
+        bits = self.__bits
+        for p in self.__positions( checksum ):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+
+        return True
+
+    def __positions( self, checksum: str ):
+        # чек-сумма уже равномерно распределена, позиции получаются двойным хешированием её частей
+        h1 = int( checksum[0:16], 16 )
+        h2 = int( checksum[16:32], 16 ) | 1
+        m = self.__bitCount
+        return [(h1 + i * h2) % m for i in range( self.__hashCount )]
+
+
+def bloomFilterFilePath( indexFilePath: pathlib.Path ):
+    return indexFilePath.with_name( indexFilePath.stem + '.bloom' + indexFilePath.suffix )
+
+
+def indexFileState( indexFilePath: pathlib.Path ) -> IndexFileState:
+    s = indexFilePath.stat()
+    return str( indexFilePath.resolve() ), s.st_size, s.st_mtime_ns
+
+
+def createBloomFilter( checksums: Sequence[str], sources: Iterable[IndexFileState] = () ):
+    bloomFilter = BloomFilter.create( len( checksums ), sources = sources )
+    for c in checksums:
+        bloomFilter.add( c )
+
+    return bloomFilter
+
+
+class FilteredFileDb( FileDb ):
+    # Индексы с актуальным фильтром Блума загружаются только при попадании в фильтр.
+    __pendingIndexes: List[Tuple[BloomFilter, Optional[pathlib.Path], pathlib.Path]]
+    __mergedFilter: Optional[BloomFilter]
+
+    def __init__( self, mergedFilterPath: Optional[pathlib.Path] = None ):
+        super().__init__()
+        self.__pendingIndexes = list()
+        self.__indexFileStates = list()
+        self.__mergedFilter = None
+        self.__mergedFilterPath = mergedFilterPath
+        self.__algorithms = list()
+
+    @property
+    def algorithms( self ):
+        algorithms = list( super().algorithms )
+        for a in self.__algorithms:
+            if a not in algorithms:
+                algorithms.append( a )
+
+        return algorithms
+
+    def addIndexedTree( self, basePath: pathlib.Path, relativePath: pathlib.Path = None ):
+        if relativePath is None:
+            relativePath = pathlib.Path()
+
+        for folderPath, indexFilePath in iterateIndexFiles( basePath, relativePath ):
+            state = indexFileState( indexFilePath )
+            self.__indexFileStates.append( state )
+            bloomFilter = self.__loadIndexFilter( indexFilePath, state )
+            if bloomFilter is not None:
+                self.__addAlgorithms( bloomFilter.algorithms )
+                self.__pendingIndexes.append( (bloomFilter, folderPath, indexFilePath) )
+            else:
+                self.addChecksumFile( folderPath, indexFilePath )
+
+    @staticmethod
+    def __loadIndexFilter( indexFilePath: pathlib.Path, state: IndexFileState ):
+        # время изменения не упорядочено при копировании с сохранением времени и восстановлении из
+        # резервной копии, поэтому фильтр используется, только если построен ровно по этому индексу
+        try:
+            bloomFilter = BloomFilter.load( bloomFilterFilePath( indexFilePath ) )
+        except FileNotFoundError:
+            return None
+
+        return bloomFilter if bloomFilter.sources == [state] else None
+
+    def __addAlgorithms( self, algorithms: Iterable[str] ):
+        for a in algorithms:
+            if a not in self.__algorithms:
+                self.__algorithms.append( a )
+
+    def __loadMergedFilter( self ):
+        # общий фильтр используется, только если построен ровно по найденным индексам в их текущем состоянии
+        mergedFilterPath = self.__mergedFilterPath
+        self.__mergedFilterPath = None
+        mergedFilter = BloomFilter.load( mergedFilterPath )
+        if sorted( mergedFilter.sources ) == sorted( self.__indexFileStates ):
+            self.__mergedFilter = mergedFilter
+        else:
+            print( f'warning: {mergedFilterPath} does not match database indexes, ignored', file = stderr )
+
+    def get( self, checksum: str ):
+        if self.__mergedFilterPath is not None:
+            self.__loadMergedFilter()
+
+        mergedFilter = self.__mergedFilter
+        if len( self.__pendingIndexes ) > 0 and (mergedFilter is None or checksum in mergedFilter):
+            pending = list()
+            for entry in self.__pendingIndexes:
+                bloomFilter, folderPath, indexFilePath = entry
+                if checksum in bloomFilter:
+                    self.addChecksumFile( folderPath, indexFilePath )
+                else:
+                    pending.append( entry )
+
+            self.__pendingIndexes = pending
+
+        return super().get( checksum )
+
+    def entries( self ):
+        for _, folderPath, indexFilePath in self.__pendingIndexes:
+            self.addChecksumFile( folderPath, indexFilePath )
+
+        self.__pendingIndexes = list()
+        return super().entries()
+
+
 defaultChecksumAlgorithm = 'sha256'
 
 
@@ -158,38 +589,346 @@ def detectChecksumAlgorithm( checksum: str ):
     return None
 
 
+def indexPathPrefix( basePath: Optional[pathlib.PurePath] ):
+    # префикс для склеивания с именами из индексного файла без создания pathlib.Path
+    if basePath is None:
+        return ''
+
+    prefix = basePath.as_posix()
+    if prefix == '.':
+        return ''
+
+    return prefix + '/'
+
+
+def iterateIndexFiles( basePath: pathlib.Path, relativePath: pathlib.Path ):
+    folderPath = basePath.joinpath( relativePath )
+    for indexFileName in ('Checksums.sha2', 'Checksums.sha1'):
+        indexFilePath = folderPath.joinpath( indexFileName )
+        if indexFilePath.exists():
+            yield relativePath, indexFilePath
+            return
+
+    with scandir( folderPath ) as it:
+        for fileEntry in it:
+            if fileEntry.is_dir():
+                yield from iterateIndexFiles( basePath, relativePath.joinpath( fileEntry.name ) )
+
+
 def calculateChecksum( filePath: pathlib.Path, algorithm: str = defaultChecksumAlgorithm ):
-    h = hashlib.new( algorithm )
+    return calculateChecksums( filePath, (algorithm,) )[algorithm]
+
+
+# файлы не меньше этого размера читаются отдельным потоком параллельно с хешированием
+overlappedHashingThreshold = 0x4000000
+
+
+@Profiler.timed( 'calculateChecksum' )
+def calculateChecksums( filePath: pathlib.Path, algorithms: Iterable[str], *, overlapped: Optional[bool] = None ):
+    algorithms = list( algorithms )
+    hashes = [hashlib.new( a ) for a in algorithms]
     with filePath.open( mode = 'rb', buffering = False ) as file:
         try:
-            while True:
-                data = file.read( 0x10000 )
-                if len( data ) == 0:
-                    break
+            if overlapped is None:
+                overlapped = fstat( file.fileno() ).st_size >= overlappedHashingThreshold
 
-                h.update( data )
+            if overlapped:
+                updateHashesOverlapped( file, hashes )
+            else:
+                updateHashes( file, hashes )
         except IOError as e:
             e.filename = str( filePath )
             raise
 
         file.close()
 
-    return h.hexdigest()
+    return { a: h.hexdigest() for a, h in zip( algorithms, hashes ) }
+
+
+def updateHashes( file: BinaryIO, hashes: List ):
+    while True:
+        data = file.read( 0x10000 )
+        if len( data ) == 0:
+            break
+
+        for h in hashes:
+            h.update( data )
+
+
+def updateHashesOverlapped( file: BinaryIO, hashes: List, bufferSize: int = 0x100000, bufferCount: int = 4 ):
+    # Кольцо буферов: поток чтения заполняет свободные буферы, пока текущий хешируется
+    # (hashlib освобождает GIL на больших блоках).
+    freeBuffers = Queue()
+    filledBuffers = Queue()
+    for _ in range( bufferCount ):
+        freeBuffers.put( bytearray( bufferSize ) )
+
+    def readBuffers():
+        try:
+            while True:
+                buffer = freeBuffers.get()
+                if buffer is None:
+                    return
+
+                size = file.readinto( buffer )
+                filledBuffers.put( (buffer, size) )
+                if size == 0:
+                    return
+        except BaseException as e:
+            filledBuffers.put( (e, 0) )
+
+    reader = Thread( target = readBuffers, name = 'checksum-reader', daemon = True )
+    reader.start()
+    try:
+        while True:
+            buffer, size = filledBuffers.get()
+            if isinstance( buffer, BaseException ):
+                raise buffer
+
+            if size == 0:
+                break
+
+            with memoryview( buffer )[:size] as data:
+                for h in hashes:
+                    h.update( data )
+
+            freeBuffers.put( buffer )
+    finally:
+        freeBuffers.put( None )
+        reader.join()
+
+
+@Profiler.timed( 'copy' )
+def copyFileWithChecksums( sourcePath: pathlib.Path, targetPath: pathlib.Path, algorithms: Iterable[str] ):
+    # копирование с вычислением чек-сумм за одно чтение исходного файла
+    algorithms = list( algorithms )
+    hashes = [hashlib.new( a ) for a in algorithms]
+    with sourcePath.open( mode = 'rb', buffering = False ) as src:
+        with targetPath.open( mode = 'xb' ) as dst:
+            try:
+                while True:
+                    data = src.read( 0x100000 )
+                    if len( data ) == 0:
+                        break
+
+                    for h in hashes:
+                        h.update( data )
+
+                    dst.write( data )
+            except IOError as e:
+                if e.filename is None:
+                    e.filename = str( sourcePath )
+                raise
+
+    # noinspection PyTypeChecker
+    shutil.copystat( sourcePath, targetPath )
+    return { a: h.hexdigest() for a, h in zip( algorithms, hashes ) }
+
+
+@Profiler.timed( 'calculateChecksum' )
+def readFileWithChecksums( filePath: pathlib.Path, algorithms: Iterable[str] ):
+    # файл читается в память целиком, чек-суммы вычисляются по прочитанным данным
+    with filePath.open( mode = 'rb', buffering = False ) as file:
+        try:
+            data = file.read()
+        except IOError as e:
+            e.filename = str( filePath )
+            raise
+
+    return data, { a: hashlib.new( a, data ).hexdigest() for a in algorithms }
+
+
+ChecksumRequest = Tuple[pathlib.Path, Sequence[str]]
+
+
+class ChecksumScheduler:
+    __executors: Dict[int, ThreadPoolExecutor]
+    __pending: List[Future]
+
+    def __init__( self, *, streamsPerDevice: int = 1 ):
+        if streamsPerDevice < 1:
+            raise ValueError( 'streamsPerDevice must be positive' )
+
+        self.__streamsPerDevice = streamsPerDevice
+        self.__executors = dict()
+        self.__pending = list()
+        self.__linkedFiles = dict()
+        self.__lock = Lock()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.close()
+
+    def close( self ):
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = list()
+            executors = self.__executors
+            self.__executors = dict()
+
+        for f in pending:
+            f.cancel()
+
+        for e in executors.values():
+            e.shutdown( wait = True )
+
+    def schedule( self, requests: Sequence[ChecksumRequest] ):
+        # Файлы группируются по устройству, внутри устройства читаются в порядке inode,
+        # чтобы каждый диск обслуживал ограниченное число потоков с минимумом позиционирований.
+        futures = [None] * len( requests )
+        order = list()
+        for index, (filePath, algorithms) in enumerate( requests ):
+            if len( algorithms ) == 0:
+                # чтение файла не требуется
+                future = Future()
+                future.set_result( dict() )
+                futures[index] = future
+                continue
+
+            try:
+                s = filePath.stat()
+                key = (s.st_dev, s.st_ino)
+                # жёсткие ссылки на один inode хешируются один раз
+                linkKey = (s.st_dev, s.st_ino, s.st_size, s.st_mtime_ns) if s.st_nlink > 1 else None
+            except OSError:
+                # ошибка будет выдана при вычислении чек-суммы
+                key = (-1, 0)
+                linkKey = None
+
+            order.append( (key, index, linkKey) )
+
+        order.sort( key = lambda x: x[:2] )
+
+        # schedule может вызываться из нескольких потоков
+        with self.__lock:
+            submitted = set()
+            for (device, _), index, linkKey in order:
+                filePath, algorithms = requests[index]
+                future = self.__findLinkedFile( linkKey, algorithms, submitted )
+                if future is None:
+                    future = self.__getExecutor( device ).submit( calculateChecksums, filePath, algorithms )
+                    submitted.add( future )
+                    if linkKey is not None:
+                        self.__linkedFiles[linkKey] = (future, frozenset( algorithms ))
+
+                futures[index] = future
+
+            self.__pending = [f for f in self.__pending if not f.done()]
+            self.__pending.extend( futures )
+
+        return futures
+
+    def __findLinkedFile( self, linkKey: Optional[Tuple], algorithms: Sequence[str], submitted: Set[Future] ):
+        if linkKey is None:
+            return None
+
+        future, linkAlgorithms = self.__linkedFiles.get( linkKey, (None, None) )
+        if future is None or not linkAlgorithms.issuperset( algorithms ):
+            return None
+
+        if future in submitted:
+            return future
+
+        # незавершённое вычисление из другого вызова может быть отменено его владельцем
+        if not future.done() or future.cancelled() or future.exception() is not None:
+            return None
+
+        return future
+
+    def __getExecutor( self, device: int ):
+        executor = self.__executors.get( device, None )
+        if executor is None:
+            executor = ThreadPoolExecutor( max_workers = self.__streamsPerDevice,
+                                           thread_name_prefix = f'checksum-{device}' )
+            self.__executors[device] = executor
+
+        return executor
+
+
+def compileGlobs( globs: Iterable[str] ) -> Optional[Pattern]:
+    # все шаблоны объединяются в одно регулярное выражение
+    globs = list( globs )
+    if len( globs ) == 0:
+        return None
+
+    return re.compile( '|'.join( fnmatch.translate( g ) for g in globs ),
+                       re.RegexFlag.IGNORECASE | re.RegexFlag.DOTALL )
+
+
+class PathExclusions:
+    __patterns: List[str]
+    __nameMatcher: Optional[Pattern]
+    __files: Set[pathlib.PurePath]
+    __folders: Dict[Optional[str], Union[dict, bool]]
+
+    def __init__( self ):
+        self.__patterns = list()
+        self.__nameMatcher = None
+        self.__files = set()
+        self.__folders = dict()
+
+    def addPattern( self, *glob: str ):
+        self.__patterns.extend( glob )
+        self.__nameMatcher = compileGlobs( self.__patterns )
+
+    def addFolder( self, folderPath: pathlib.PurePath ):
+        node = self.__folders
+        for part in folderPath.parts:
+            node = node.setdefault( normcase( part ), dict() )
+
+        # None - признак исключённого префикса
+        node[None] = True
+
+    def addFile( self, filePath: pathlib.PurePath ):
+        self.__files.add( filePath )
+
+    def isNameExcluded( self, name: str ):
+        matcher = self.__nameMatcher
+        return matcher is not None and matcher.match( name ) is not None
+
+    def isFolderExcluded( self, folderPath: pathlib.PurePath ):
+        return self.__matchFolder( folderPath.parts )
+
+    def isFileExcluded( self, filePath: pathlib.PurePath ):
+        if filePath in self.__files:
+            return True
+
+        if self.__matchFolder( filePath.parts[:-1] ):
+            return True
+
+        return self.isNameExcluded( filePath.name )
+
+    def __matchFolder( self, parts: Sequence[str] ):
+        node = self.__folders
+        if len( node ) == 0:
+            return False
+
+        for part in parts:
+            node = node.get( normcase( part ), None )
+            if node is None:
+                return False
+
+            if None in node:
+                return True
+
+        return False
 
 
 class FileTreeIterator:
-    __excluded: List[Pattern]
+    __excluded: List[str]
+    __nameMatcher: Optional[Pattern]
 
     def __init__( self ):
         self.__excluded = []
+        self.__nameMatcher = None
 
     def addExcluded( self, *glob: str ):
-        for g in glob:
-            self.__excluded.append(
-                re.compile( fnmatch.translate( g ),
-                            re.RegexFlag.IGNORECASE | re.RegexFlag.DOTALL ) )
+        self.__excluded.extend( glob )
+        self.__nameMatcher = compileGlobs( self.__excluded )
 
-    def iterate( self, basePath: pathlib.Path ):
+    def iterate( self, basePath: pathlib.Path, exclusions: Optional[PathExclusions] = None ):
         iteratorStack = list()
         subdir = pathlib.Path()
         iterator = self.__scanDir( basePath )
@@ -198,8 +937,9 @@ class FileTreeIterator:
                 entry = next( iterator )
                 filePath = subdir.joinpath( entry.name )
                 if not entry.is_dir():
-                    yield filePath
-                else:
+                    if exclusions is None or not exclusions.isFileExcluded( filePath ):
+                        yield filePath
+                elif exclusions is None or not exclusions.isFolderExcluded( filePath ):
                     iteratorStack.append( iterator )
                     iterator = self.__scanDir( basePath.joinpath( filePath ) )
                     subdir = filePath
@@ -211,24 +951,44 @@ class FileTreeIterator:
                 subdir = subdir.parent
                 iterator = iteratorStack.pop()
 
+    @Profiler.timed( 'FileTreeIterator.scanDir' )
     def __scanDir( self, folder: pathlib.Path ):
-        return iter( sorted(
-            filter( lambda x: self.__checkName( x.name ),
-                    scandir( folder ) ), key = lambda x: x.name.lower() ) )
-
-    def __checkName( self, name: str ):
-        for e in self.__excluded:
-            if e.match( name ):
-                return False
+        with scandir( folder ) as it:
+            matcher = self.__nameMatcher
+            if matcher is None:
+                entries = list( it )
+            else:
+                match = matcher.match
+                entries = [e for e in it if match( e.name ) is None]
 
-        return True
+        entries.sort( key = lambda x: x.name.lower() )
+        return iter( entries )
 
 
 class ChecksumFileReader:
+    """Reads text checksum files and block index files (version 2) detected by their header."""
+
     def __init__( self, filePath: Union[str, pathlib.PurePath] ):
-        self.__file = open( filePath, mode = 'rt', encoding = 'utf-8' )
+        file = open( filePath, mode = 'rb' )
+        try:
+            self.__blockFile = BlockChecksumFile.open( file )
+        except BaseException:
+            file.close()
+            raise
+
+        if self.__blockFile is None:
+            self.__file = io.TextIOWrapper( file, encoding = 'utf-8' )
+        else:
+            self.__file = file
+
+        self.__blocks = None
+        self.__lines = deque()
         self.__lineNo = 0
 
+    @property
+    def version( self ):
+        return 1 if self.__blockFile is None else 2
+
     def __enter__( self ):
         return self
 
@@ -241,10 +1001,11 @@ class ChecksumFileReader:
     def __iter__( self ):
         return self
 
+    @Profiler.timed( 'ChecksumFileReader.next' )
     def __next__( self ):
         while True:
             try:
-                l = self.__file.readline()
+                l = self.__readLine()
             except UnicodeDecodeError as e:
                 fileName = self.__file.name
                 raise IOError( f'{fileName}: {e}' ) from e
@@ -268,6 +1029,99 @@ class ChecksumFileReader:
 
             return pathlib.Path( n ), c
 
+    def __readLine( self ):
+        if self.__blockFile is None:
+            return self.__file.readline()
+
+        lines = self.__lines
+        while len( lines ) == 0:
+            if self.__blocks is None:
+                self.__blocks = self.__blockFile.readSection( BlockChecksumFile.checksumSection )
+
+            block = next( self.__blocks, None )
+            if block is None:
+                return ''
+
+            # splitlines() разделяет и по символам, допустимым в именах файлов;
+            # пустая строка означает конец файла, поэтому перевод строки сохраняется
+            lines.extend( l + '\n' for l in block.split( '\n' )[:-1] )
+
+        return lines.popleft()
+
+    def readBatches( self, blockSize: int = 0x100000 ):
+        # Блочное чтение: строки возвращаются пачками в виде (имя, чек-сумма),
+        # pathlib.Path не создаётся.
+        if self.__blockFile is not None:
+            # блоки индекса версии 2 всегда заканчиваются полной строкой
+            for block in self.__blockFile.readSection( BlockChecksumFile.checksumSection ):
+                yield self.__parseLines( block.split( '\n' ) )
+            return
+
+        file = self.__file
+        tail = ''
+        while True:
+            try:
+                block = file.read( blockSize )
+            except UnicodeDecodeError as e:
+                raise IOError( f'{file.name}: {e}' ) from e
+
+            if block == '':
+                if tail != '':
+                    yield self.__parseLines( [tail] )
+                break
+
+            lines = (tail + block).split( '\n' )
+            tail = lines.pop()
+            if len( lines ) > 0:
+                yield self.__parseLines( lines )
+
+    @Profiler.timed( 'ChecksumFileReader.parseLines' )
+    def __parseLines( self, lines: List[str] ):
+        batch = list()
+        lineNo = self.__lineNo
+        for l in lines:
+            lineNo += 1
+            if l == '':
+                continue
+
+            c, s, n = l.partition( ' ' )
+            if n != '' and (n[0] == '*' or n[0] == ' '):
+                n = n[1:]
+
+            if s == '' or n == '':
+                fileName = self.__file.name
+                raise ValueError( f'Invalid checksum line #{lineNo} in {fileName}' )
+
+            batch.append( (n, c) )
+
+        self.__lineNo = lineNo
+        return batch
+
+    def findByChecksum( self, checksum: str ):
+        """Returns names of all files with given checksum."""
+        names = list()
+        for batch in self.__lookupBatches( BlockChecksumFile.checksumSection, checksum ):
+            names.extend( n for n, c in batch if c == checksum )
+
+        return names
+
+    def findByPath( self, filePath: pathlib.PurePath ):
+        """Returns checksum of given file or None."""
+        name = './' + filePath.as_posix()
+        for batch in self.__lookupBatches( BlockChecksumFile.pathSection, name ):
+            for n, c in batch:
+                if n == name or pathlib.PurePath( n ) == filePath:
+                    return c
+
+        return None
+
+    def __lookupBatches( self, section: int, key: str ):
+        if self.__blockFile is None:
+            return self.readBatches()
+
+        # в индексе версии 2 читаются только блоки, которые могут содержать ключ
+        return (self.__parseLines( b.split( '\n' ) ) for b in self.__blockFile.readBlocks( section, key ))
+
     @property
     def filePath( self ):
         return pathlib.Path( self.__file.name )
@@ -294,22 +1148,446 @@ class ChecksumFileWriter:
         return pathlib.Path( self.__file.name )
 
 
+indexVersions = (1, 2)
+
+
+class BlockChecksumFile:
+    """Index file version 2: header, zlib compressed blocks of checksum lines sorted by checksum,
+    the same lines sorted by path and a directory with the first key of every block."""
+
+    magic = b'PAIX'
+    header = struct.Struct( '<4sBxxxQQ' )
+    directoryEntry = struct.Struct( '<BQIH' )
+
+    checksumSection = 0
+    pathSection = 1
+
+    __directory: Dict[int, Tuple[List[str], List[Tuple[int, int]]]]
+
+    def __init__( self, file: BinaryIO, entryCount: int,
+                  directory: Dict[int, Tuple[List[str], List[Tuple[int, int]]]] ):
+        self.__file = file
+        self.__entryCount = entryCount
+        self.__directory = directory
+
+    @classmethod
+    def open( cls, file: io.BufferedReader ):
+        # текстовый файл чек-сумм не может начинаться с сигнатуры; сигнатура проверяется без seek(),
+        # чтобы текстовый файл можно было читать из канала
+        if file.peek( len( cls.magic ) )[:len( cls.magic )] != cls.magic:
+            return None
+
+        if not file.seekable():
+            raise ValueError( f'Index file version 2 cannot be read from stream: {file.name}' )
+
+        data = file.read( cls.header.size )
+        if len( data ) < cls.header.size:
+            raise ValueError( f'Invalid index file header in {file.name}' )
+
+        _, version, entryCount, directoryOffset = cls.header.unpack( data )
+        if version != 2:
+            raise ValueError( f'Unsupported index file version {version} in {file.name}' )
+
+        file.seek( directoryOffset )
+        directory = { cls.checksumSection: ([], []), cls.pathSection: ([], []) }
+        blockCount, = struct.unpack( '<I', file.read( 4 ) )
+        for _ in range( blockCount ):
+            section, offset, size, keyLength = cls.directoryEntry.unpack( file.read( cls.directoryEntry.size ) )
+            keys, blocks = directory[section]
+            keys.append( file.read( keyLength ).decode( 'utf-8' ) )
+            blocks.append( (offset, size) )
+
+        return cls( file, entryCount, directory )
+
+    @property
+    def entryCount( self ):
+        return self.__entryCount
+
+    def readSection( self, section: int ):
+        for i in range( len( self.__directory[section][1] ) ):
+            yield self.__readBlock( section, i )
+
+    def readBlocks( self, section: int, key: str ):
+        # строки с одинаковым ключом могут продолжаться из предыдущего блока
+        keys, _ = self.__directory[section]
+        i = max( bisect_left( keys, key ) - 1, 0 )
+        while i < len( keys ) and keys[i] <= key:
+            yield self.__readBlock( section, i )
+            i += 1
+
+    def __readBlock( self, section: int, i: int ):
+        offset, size = self.__directory[section][1][i]
+        file = self.__file
+        file.seek( offset )
+        try:
+            return zlib.decompress( file.read( size ) ).decode( 'utf-8' )
+        except (zlib.error, UnicodeDecodeError) as e:
+            raise IOError( f'{file.name}: {e}' ) from e
+
+
+class BlockChecksumFileWriter:
+    """Writes index file version 2, entries are collected in memory and written on close."""
+
+    blockSize = 0x10000
+
+    __entries: List[Tuple[str, str]]
+
+    def __init__( self, filePath: Union[str, pathlib.PurePath] ):
+        self.__file = open( filePath, mode = 'wb' )
+        self.__entries = list()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.close()
+
+    def close( self ):
+        if self.__file.closed:
+            return
+
+        try:
+            self.__writeIndex()
+        finally:
+            self.__file.close()
+
+    def write( self, filePath: pathlib.PurePath, checksum: str ):
+        self.__entries.append( (checksum, './' + filePath.as_posix()) )
+
+    @property
+    def filePath( self ):
+        return pathlib.Path( self.__file.name )
+
+    def __writeIndex( self ):
+        file = self.__file
+        entries = self.__entries
+        file.write( BlockChecksumFile.header.pack( BlockChecksumFile.magic, 2, 0, 0 ) )
+
+        directory = list()
+        entries.sort()
+        self.__writeSection( BlockChecksumFile.checksumSection, entries, 0, directory )
+        entries.sort( key = lambda e: e[1] )
+        self.__writeSection( BlockChecksumFile.pathSection, entries, 1, directory )
+
+        directoryOffset = file.tell()
+        file.write( struct.pack( '<I', len( directory ) ) )
+        for section, offset, size, key in directory:
+            key = key.encode( 'utf-8' )
+            file.write( BlockChecksumFile.directoryEntry.pack( section, offset, size, len( key ) ) )
+            file.write( key )
+
+        file.seek( 0 )
+        file.write( BlockChecksumFile.header.pack( BlockChecksumFile.magic, 2, len( entries ), directoryOffset ) )
+
+    def __writeSection( self, section: int, entries: List[Tuple[str, str]], keyIndex: int, directory: List ):
+        file = self.__file
+        lines = list()
+        size = 0
+        for i, entry in enumerate( entries ):
+            c, n = entry
+            line = f'{c} *{n}\n'
+            lines.append( line )
+            size += len( line )
+            if size < self.blockSize and i + 1 < len( entries ):
+                continue
+
+            # ключ блока - первая строка в порядке сортировки секции
+            key = entries[i + 1 - len( lines )][keyIndex]
+            data = zlib.compress( ''.join( lines ).encode( 'utf-8' ) )
+            directory.append( (section, file.tell(), len( data ), key) )
+            file.write( data )
+            lines = list()
+            size = 0
+
+
+def createChecksumFileWriter( filePath: Union[str, pathlib.PurePath], version: int = 1 ):
+    if version == 1:
+        return ChecksumFileWriter( filePath )
+    elif version == 2:
+        return BlockChecksumFileWriter( filePath )
+    else:
+        raise ValueError( f'unknown index file version: {version}' )
+
+
+def folderDigestsFilePath( indexFilePath: pathlib.Path ):
+    return indexFilePath.with_name( indexFilePath.stem + '.tree' + indexFilePath.suffix )
+
+
+def calculateFolderDigests( entries: Iterable[Tuple[pathlib.Path, str]] ):
+    # Дайджест папки - хеш отсортированных строк "чек-сумма *имя" для файлов папки
+    # и "дайджест *имя/" для вложенных папок.
+    root = pathlib.Path()
+    folderFiles = dict()
+    for filePath, checksum in entries:
+        folderFiles.setdefault( filePath.parent, list() ).append( (filePath.name, checksum) )
+
+    subfolders = dict()
+    allFolders = { root }
+    for folder in folderFiles.keys():
+        while folder not in allFolders:
+            allFolders.add( folder )
+            subfolders.setdefault( folder.parent, list() ).append( folder )
+            folder = folder.parent
+
+    digests = dict()
+    for folder in sorted( allFolders, key = lambda x: len( x.parts ), reverse = True ):
+        items = list( folderFiles.get( folder, () ) )
+        items.extend( (f.name + '/', digests[f]) for f in subfolders.get( folder, () ) )
+        items.sort()
+
+        h = hashlib.new( defaultChecksumAlgorithm )
+        for name, checksum in items:
+            h.update( f'{checksum} *{name}\n'.encode( 'utf-8' ) )
+
+        digests[folder] = h.hexdigest()
+
+    return digests
+
+
+def writeChecksumFile( filePath: pathlib.Path, entries: Iterable[Tuple[pathlib.PurePath, str]], version: int = 1 ):
+    # запись во временный файл с последующим атомарным переименованием
+    tempFilePath = filePath.with_name( filePath.stem + '.tmp' + filePath.suffix )
+    try:
+        with createChecksumFileWriter( tempFilePath, version ) as writer:
+            for fp, c in entries:
+                writer.write( fp, c )
+
+        tempFilePath.replace( filePath )
+    except BaseException:
+        try:
+            tempFilePath.unlink()
+        except OSError:
+            pass
+        raise
+
+
+# Первая запись файла дайджестов - размер и время изменения индекса, по которому он построен.
+# Порядок времени изменения не сохраняется при копировании и восстановлении из резервной копии,
+# поэтому файл дайджестов действителен только для индекса ровно в этом состоянии.
+indexStateKey = pathlib.Path( '..' )
+
+
+def indexStateValue( indexFilePath: pathlib.Path ):
+    s = indexFilePath.stat()
+    return f'{s.st_size}:{s.st_mtime_ns}'
+
+
+def writeFolderDigests( indexFilePath: pathlib.Path, digests: Dict[pathlib.Path, str] ):
+    entries = [(indexStateKey, indexStateValue( indexFilePath ))]
+    entries.extend( sorted( digests.items() ) )
+    writeChecksumFile( folderDigestsFilePath( indexFilePath ), entries )
+
+
+def readFolderDigests( indexFilePath: pathlib.Path ):
+    try:
+        with ChecksumFileReader( folderDigestsFilePath( indexFilePath ) ) as reader:
+            digests = { fp: c for fp, c in reader }
+    except FileNotFoundError:
+        digests = dict()
+
+    if digests.pop( indexStateKey, None ) == indexStateValue( indexFilePath ):
+        return digests
+
+    # файл дайджестов отсутствует или построен по другому состоянию индекса
+    with ChecksumFileReader( indexFilePath ) as reader:
+        return calculateFolderDigests( reader )
+
+
+def findChangedFolders( left: Dict[pathlib.Path, str], right: Dict[pathlib.Path, str] ):
+    # спуск только в папки с различающимися дайджестами
+    root = pathlib.Path()
+    changed = set()
+    if left.get( root, None ) == right.get( root, None ):
+        return changed
+
+    subfolders = dict()
+    for folder in set( left.keys() ).union( right.keys() ):
+        if folder != root:
+            subfolders.setdefault( folder.parent, list() ).append( folder )
+
+    stack = [root]
+    while len( stack ) > 0:
+        folder = stack.pop()
+        changed.add( folder )
+        for f in subfolders.get( folder, () ):
+            if left.get( f, None ) != right.get( f, None ):
+                stack.append( f )
+
+    return changed
+
+
+def makeNewIndexFilePath( filePath: pathlib.Path ):
+    stem = filePath.stem + strftime( '-%Y%m%d_%H%M%S' )
+    suffix = filePath.suffix
+
+    newFilePath = filePath.with_name( stem + suffix )
+    attempt = 0
+    while True:
+        if not newFilePath.exists():
+            break
+
+        attempt += 1
+        if attempt >= 50:
+            raise FileExistsError( f'Unable to create new file in {newFilePath.parent}' )
+
+        newFilePath = newFilePath.with_name( stem + '_' + secrets.token_hex( 2 ) + suffix )
+
+    return newFilePath
+
+
+def indexFileAlgorithm( indexFilePath: pathlib.PurePath ):
+    return 'sha1' if indexFilePath.suffix.lower() == '.sha1' else defaultChecksumAlgorithm
+
+
+def appendIndexEntries( indexFilePath: pathlib.Path, entries: Iterable[Tuple[pathlib.PurePath, str]] ):
+    # Новый индекс записывается рядом и заменяет старый так же, как в IndexBuilder.
+    allEntries = list()
+    version = 1
+    if indexFilePath.exists():
+        with ChecksumFileReader( indexFilePath ) as reader:
+            allEntries.extend( reader )
+            version = reader.version
+
+    allEntries.extend( entries )
+    newFilePath = makeNewIndexFilePath( indexFilePath )
+    try:
+        with createChecksumFileWriter( newFilePath, version ) as writer:
+            for fp, c in allEntries:
+                writer.write( fp, c )
+    except BaseException:
+        try:
+            newFilePath.unlink()
+        except OSError:
+            pass
+        raise
+
+    if indexFilePath.exists():
+        indexFilePath.unlink()
+
+    newFilePath.rename( indexFilePath )
+
+    writeFolderDigests( indexFilePath, calculateFolderDigests( allEntries ) )
+
+
+resultFormats = ('text', 'nul', 'jsonl')
+
+# status, path, target, checksum, text -> record
+RecordFormatter = Callable[[str, str, Optional[str], Optional[str], Optional[str]], str]
+
+
+def formatTextRecord( status: str, path: str, target: Optional[str], checksum: Optional[str], text: Optional[str] ):
+    if text is not None:
+        return text + '\n'
+
+    if target is None:
+        return f'{status} {path}\n'
+
+    return f'{status} {path} {target}\n'
+
+
+def formatNulRecord( status: str, path: str, target: Optional[str], checksum: Optional[str], text: Optional[str] ):
+    # каждая запись - ровно три поля, пустое поле означает отсутствие целевого пути
+    return f'{status}\0{path}\0{target or ""}\0'
+
+
+def formatJsonRecord( status: str, path: str, target: Optional[str], checksum: Optional[str], text: Optional[str] ):
+    record = { 'status': status, 'path': path, 'target': target, 'checksum': checksum }
+    return json.dumps( record, ensure_ascii = False ) + '\n'
+
+
+class ResultSink:
+    """Buffered output of result records: status, path, optional target path and checksum."""
+
+    def __init__( self, file: Optional[TextIO] = None, formatter: RecordFormatter = formatTextRecord, *,
+                  messageFile: Optional[TextIO] = None, withChecksums: bool = False,
+                  bufferSize: int = 0x10000 ):
+        self.__file = file if file is not None else stdout
+        self.__formatter = formatter
+        self.__messageFile = messageFile if messageFile is not None else self.__file
+        self.__withChecksums = withChecksums
+        self.__bufferSize = bufferSize
+        self.__buffer = list()
+        self.__bufferedSize = 0
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.flush()
+
+    @property
+    def file( self ):
+        return self.__file
+
+    @property
+    def withChecksums( self ):
+        """Records include checksums, so they are worth calculating for reported files."""
+        return self.__withChecksums
+
+    def write( self, status: str, path: Union[pathlib.PurePath, str], *,
+               target: Union[pathlib.PurePath, str, None] = None, checksum: Optional[str] = None,
+               text: Optional[str] = None ):
+        record = self.__formatter( status, str( path ), None if target is None else str( target ), checksum, text )
+        self.__buffer.append( record )
+        self.__bufferedSize += len( record )
+        if self.__bufferedSize >= self.__bufferSize:
+            self.flush()
+
+    def message( self, text: str ):
+        # сводка для человека выводится после уже накопленных результатов
+        self.flush()
+        print( text, file = self.__messageFile )
+
+    def flush( self ):
+        if len( self.__buffer ) == 0:
+            return
+
+        self.__file.write( ''.join( self.__buffer ) )
+        self.__file.flush()
+        self.__buffer.clear()
+        self.__bufferedSize = 0
+
+
+def createResultSink( resultFormat: str, file: Optional[TextIO] = None ):
+    # в машинных форматах сообщения выводятся в stderr, чтобы не смешиваться с результатами
+    if resultFormat == 'text':
+        return ResultSink( file, formatTextRecord )
+    elif resultFormat == 'nul':
+        return ResultSink( file, formatNulRecord, messageFile = stderr )
+    elif resultFormat == 'jsonl':
+        return ResultSink( file, formatJsonRecord, messageFile = stderr, withChecksums = True )
+    else:
+        raise ValueError( f'unknown result format: {resultFormat}' )
+
+
 class IndexValidationError( Exception ):
     pass
 
 
+class IndexBuildCancelled( Exception ):
+    pass
+
+
 class IndexBuilder:
     __oldIndexFilePath: Optional[pathlib.Path]
     __fileChecksumMap: Dict[pathlib.Path, str]
     __newIndexFilePath: Optional[pathlib.Path]
-    __newIndexWriter: Optional[ChecksumFileWriter]
+    __newIndexWriter: Union[ChecksumFileWriter, BlockChecksumFileWriter, None]
 
     def __init__( self, *, folder: pathlib.Path, fileTreeIterator: FileTreeIterator,
                   create: bool = False, verify: False,
                   indexFileName: Optional[pathlib.Path] = None,
                   rejectChanges: bool = True, reviewChanges: bool = True,
-                  reuseChecksums: bool = False ):
+                  reuseChecksums: bool = False,
+                  checksumScheduler: Optional[ChecksumScheduler] = None,
+                  output: Optional[TextIO] = None, bloomFilter: bool = False,
+                  backupOldIndex: bool = False, resultFormat: str = 'text',
+                  indexVersion: Optional[int] = None ):
         self.__fileTreeIterator = fileTreeIterator
+        self.__checksumScheduler = checksumScheduler
+        self.__output = output if output is not None else stdout
+        self.__results = createResultSink( resultFormat, self.__output )
+        self.__cancelled = False
         self.__indexFileName = indexFileName
         self.__basePath = folder
 
@@ -319,12 +1597,16 @@ class IndexBuilder:
         self.__rejectChanges = rejectChanges
         self.__reviewChanges = reviewChanges
         self.__reuseChecksums = reuseChecksums
+        self.__bloomFilter = bloomFilter
+        self.__backupOldIndex = backupOldIndex
+        self.__indexVersion = indexVersion
 
         self.__newIndexFilePath = None
         self.__newIndexWriter = None
 
         self.__oldIndexFilePath = None
         self.__fileChecksumMap = dict()
+        self.__newEntries = list()
 
         self.__newCount = 0
         self.__missingCount = 0
@@ -334,20 +1616,29 @@ class IndexBuilder:
     def folderName( self ):
         return self.__basePath.as_posix()
 
+    @property
+    def output( self ):
+        return self.__output
+
+    def cancel( self ):
+        # может вызываться из другого потока, проверяется перед обработкой каждого файла
+        self.__cancelled = True
+
     def run( self ):
         assert self.__create or self.__verify
         try:
             rc = self.__process()
         finally:
             self.__cleanup()
+            self.__results.flush()
 
         missing = self.__missingCount
         damaged = self.__damagedCount
         new = self.__newCount
         if missing > 0 or damaged > 0 or new > 0:
-            print( f'{self.folderName}: damaged = {damaged}, missing = {missing}, new = {new}' )
+            self.__results.message( f'{self.folderName}: damaged = {damaged}, missing = {missing}, new = {new}' )
         else:
-            print( f'{self.folderName}: OK' )
+            self.__results.message( f'{self.folderName}: OK' )
 
         return rc
 
@@ -366,8 +1657,26 @@ class IndexBuilder:
         if self.__verify:
             self.__checkMissing( fileList )
 
-        for fp in fileList:
-            self.__processFile( fp )
+        scheduler = self.__checksumScheduler
+        ownScheduler = scheduler is None
+        if ownScheduler:
+            scheduler = ChecksumScheduler()
+
+        pending = []
+        try:
+            requests = [(self.__basePath.joinpath( fp ), self.__requiredAlgorithms( fp )) for fp in fileList]
+            pending = scheduler.schedule( requests )
+            for fp, checksums in zip( fileList, pending ):
+                if self.__cancelled:
+                    raise IndexBuildCancelled( f'{self.folderName}: cancelled' )
+
+                self.__processFile( fp, checksums )
+        finally:
+            for f in pending:
+                f.cancel()
+
+            if ownScheduler:
+                scheduler.close()
 
         if not self.__create:
             return self.__missingCount == 0 and self.__damagedCount == 0
@@ -407,6 +1716,10 @@ class IndexBuilder:
 
         with reader:
             self.__oldIndexFilePath = reader.filePath
+            if self.__indexVersion is None:
+                # при обновлении сохраняется формат прежнего индекса
+                self.__indexVersion = reader.version
+
             for fp, c in reader:
                 self.__fileChecksumMap[fp] = c
 
@@ -424,22 +1737,40 @@ class IndexBuilder:
             if fp in fileSet:
                 continue
 
-            print( 'm', self.__prettyFileName( fp ) )
+            self.__results.write( 'm', self.__prettyFileName( fp ), checksum = self.__fileChecksumMap[fp] )
             self.__missingCount += 1
 
         if self.__rejectChanges and self.__missingCount > 0:
             self.__raiseValidationError()
 
-    def __processFile( self, filePath: pathlib.Path ):
+    def __requiredAlgorithms( self, filePath: pathlib.Path ):
+        algorithms = list()
+        algorithm = None
+        if self.__verify:
+            reference = self.__fileChecksumMap.get( filePath, None )
+            if reference is not None:
+                algorithm = detectChecksumAlgorithm( reference )
+                if not self.__reuseChecksums:
+                    algorithms.append( algorithm )
+
+        if self.__create and algorithm != defaultChecksumAlgorithm:
+            algorithms.append( defaultChecksumAlgorithm )
+        elif self.__verify and algorithm is None and self.__results.withChecksums:
+            # при проверке новый файл читается, только если его чек-сумма выводится
+            algorithms.append( defaultChecksumAlgorithm )
+
+        return algorithms
+
+    def __processFile( self, filePath: pathlib.Path, pending: Future ):
         checksum = None
         algorithm = None
+        isNew = False
 
-        fullFilePath = self.__basePath.joinpath( filePath )
         if self.__verify:
             reference = self.__fileChecksumMap.get( filePath, None )
             if reference is None:
                 self.__newCount += 1
-                print( 'n', self.__prettyFileName( filePath ) )
+                isNew = True
             else:
                 refAlgorithm = detectChecksumAlgorithm( reference )
                 if self.__reuseChecksums:
@@ -448,11 +1779,11 @@ class IndexBuilder:
                 else:
                     if refAlgorithm != algorithm:
                         algorithm = refAlgorithm
-                        checksum = calculateChecksum( fullFilePath, algorithm )
+                        checksum = pending.result()[algorithm]
 
                     if checksum != reference:
                         self.__damagedCount += 1
-                        print( 'd', self.__prettyFileName( filePath ) )
+                        self.__results.write( 'd', self.__prettyFileName( filePath ), checksum = checksum )
                         if self.__rejectChanges:
                             self.__raiseValidationError()
 
@@ -461,51 +1792,43 @@ class IndexBuilder:
 
             if algorithm != defaultChecksumAlgorithm:
                 algorithm = defaultChecksumAlgorithm
-                checksum = calculateChecksum( fullFilePath, algorithm )
+                checksum = pending.result()[algorithm]
 
             self.__newIndexWriter.write( filePath, checksum )
+            self.__newEntries.append( (filePath, checksum) )
+
+        if isNew:
+            if checksum is None and self.__results.withChecksums:
+                checksum = pending.result()[defaultChecksumAlgorithm]
+
+            self.__results.write( 'n', self.__prettyFileName( filePath ), checksum = checksum )
 
     def __openNewIndex( self ):
         if self.__newIndexFilePath is not None:
             return
 
-        filePath = self.__getIndexFilePath()
-
-        stem = filePath.stem + strftime( '-%Y%m%d_%H%M%S' )
-        suffix = filePath.suffix
-
-        newFilePath = filePath.with_name( stem + suffix )
-        attempt = 0
-        while True:
-            if not newFilePath.exists():
-                break
-
-            attempt += 1
-            if attempt >= 50:
-                raise FileExistsError( f'Unable to create new file in {newFilePath.parent}' )
-
-            newFilePath = newFilePath.with_name( stem + '_' + secrets.token_hex( 2 ) + suffix )
-
-        self.__newIndexWriter = ChecksumFileWriter( newFilePath )
+        newFilePath = makeNewIndexFilePath( self.__getIndexFilePath() )
+        self.__newIndexWriter = createChecksumFileWriter( newFilePath, self.__indexVersion or 1 )
         self.__newIndexFilePath = newFilePath
 
     def __commitNewIndex( self ):
         self.__closeNewIndexWriter()
 
         if self.__newIndexFilePath is None:
-            print( f'{self.folderName}: no files found, index not created' )
+            self.__results.message( f'{self.folderName}: no files found, index not created' )
 
         success = self.__missingCount == 0 and self.__damagedCount == 0
         if not success and self.__reviewChanges:
             newIndexFile = self.__newIndexFilePath
             if newIndexFile is not None:
                 self.__newIndexFilePath = None
-                print( f'{self.folderName}: new index: {newIndexFile.as_posix()}' )
+                self.__results.message( f'{self.folderName}: new index: {newIndexFile.as_posix()}' )
 
             return False
         else:
-            self.__removeOldIndex( not success )
+            self.__removeOldIndex( not success or self.__backupOldIndex )
             self.__renameNewIndex()
+            self.__updateFolderDigests()
             return True
 
     def __removeOldIndex( self, makeBackup: bool ):
@@ -539,6 +1862,20 @@ class IndexBuilder:
         self.__newIndexFilePath = None
         newIndexFile.rename( self.__getIndexFilePath() )
 
+    def __updateFolderDigests( self ):
+        indexFilePath = self.__getIndexFilePath()
+        digestsFilePath = folderDigestsFilePath( indexFilePath )
+        if len( self.__newEntries ) > 0:
+            writeFolderDigests( indexFilePath, calculateFolderDigests( self.__newEntries ) )
+            if self.__bloomFilter:
+                bloomFilter = createBloomFilter( [c for _, c in self.__newEntries], [indexFileState( indexFilePath )] )
+                bloomFilter.save( bloomFilterFilePath( indexFilePath ) )
+        else:
+            try:
+                digestsFilePath.unlink()
+            except FileNotFoundError:
+                pass
+
     def __closeNewIndexWriter( self, nothrow: bool = False ):
         newIndexWriter = self.__newIndexWriter
         if newIndexWriter is None:
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import functools
+import pathlib
+import pstats
+import sys
+from collections import Counter
+from contextlib import nullcontext
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, TextIO
+
+profilerModes = ('sample', 'cprofile')
+
+
+class SpanRecorder:
+    """Call counts and total time of named spans, active span of every thread for sampling profiler."""
+
+    __stats: Dict[str, List]
+    __active: Dict[int, List[str]]
+
+    def __init__( self ):
+        self.__lock = Lock()
+        self.__stats = dict()
+        self.__active = dict()
+
+    def enter( self, name: str ):
+        # список активных участков изменяется только своим потоком
+        self.__active.setdefault( get_ident(), [] ).append( name )
+        return perf_counter()
+
+    def exit( self, name: str, start: float ):
+        elapsed = perf_counter() - start
+        self.__active[get_ident()].pop()
+        with self.__lock:
+            stats = self.__stats.get( name, None )
+            if stats is None:
+                stats = [0, 0.0]
+                self.__stats[name] = stats
+
+            stats[0] += 1
+            stats[1] += elapsed
+
+    def activeSpan( self, threadId: int ):
+        # вызывается из потока профилировщика, список может измениться во время чтения
+        try:
+            return self.__active[threadId][-1]
+        except (KeyError, IndexError):
+            return None
+
+    def stats( self ):
+        with self.__lock:
+            return { name: tuple( s ) for name, s in self.__stats.items() }
+
+
+recorder: Optional[SpanRecorder] = None
+
+
+class Span:
+    __slots__ = ["__name", "__recorder", "__start"]
+
+    def __init__( self, name: str, spanRecorder: SpanRecorder ):
+        self.__name = name
+        self.__recorder = spanRecorder
+        self.__start = None
+
+    def __enter__( self ):
+        self.__start = self.__recorder.enter( self.__name )
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.__recorder.exit( self.__name, self.__start )
+
+
+disabledSpan = nullcontext()
+
+
+def span( name: str ):
+    """Context manager measuring named span when profiling is enabled."""
+    spanRecorder = recorder
+    if spanRecorder is None:
+        return disabledSpan
+
+    return Span( name, spanRecorder )
+
+
+def timed( name: str ):
+    """Decorator measuring every call of function as named span when profiling is enabled."""
+    def decorate( func ):
+        @functools.wraps( func )
+        def wrapper( *args, **kwargs ):
+            spanRecorder = recorder
+            if spanRecorder is None:
+                return func( *args, **kwargs )
+
+            start = spanRecorder.enter( name )
+            try:
+                return func( *args, **kwargs )
+            finally:
+                spanRecorder.exit( name, start )
+
+        return wrapper
+
+    return decorate
+
+
+class SamplingProfiler:
+    """Records stacks of all threads periodically; interval grows when sampling costs more than
+    maxOverhead share of wall time."""
+
+    maxDepth = 100
+
+    def __init__( self, spanRecorder: SpanRecorder, interval: float = 0.01, maxOverhead: float = 0.01 ):
+        self.__recorder = spanRecorder
+        self.__interval = interval
+        self.__maxOverhead = maxOverhead
+        self.__stopped = Event()
+        self.__thread = Thread( target = self.__run, name = 'SamplingProfiler', daemon = True )
+
+        self.__sampleCount = 0
+        self.__samplingTime = 0.0
+        self.__selfSamples = Counter()
+        self.__inclusiveSamples = Counter()
+        self.__spanSamples = Counter()
+
+    def start( self ):
+        self.__thread.start()
+
+    def stop( self ):
+        self.__stopped.set()
+        self.__thread.join()
+
+    def __run( self ):
+        ownId = get_ident()
+        interval = self.__interval
+        while not self.__stopped.wait( interval ):
+            start = perf_counter()
+            for threadId, frame in sys._current_frames().items():
+                if threadId != ownId:
+                    self.__sample( threadId, frame )
+
+            cost = perf_counter() - start
+            self.__samplingTime += cost
+            interval = max( self.__interval, cost / self.__maxOverhead )
+
+    def __sample( self, threadId: int, frame ):
+        self.__sampleCount += 1
+        self.__spanSamples[self.__recorder.activeSpan( threadId ) or '-'] += 1
+
+        self.__selfSamples[frameName( frame )] += 1
+        names = set()
+        depth = 0
+        while frame is not None and depth < self.maxDepth:
+            names.add( frameName( frame ) )
+            frame = frame.f_back
+            depth += 1
+
+        self.__inclusiveSamples.update( names )
+
+    def writeReport( self, file: TextIO, wallTime: float, top: int = 40 ):
+        count = self.__sampleCount
+        overhead = self.__samplingTime / wallTime if wallTime > 0 else 0.0
+        print( f'Sampling: {count} thread samples, interval {self.__interval * 1000:.1f} ms, '
+               f'profiler time {self.__samplingTime:.3f} s ({overhead:.1%})', file = file )
+        if count == 0:
+            return
+
+        for title, samples in (('Samples by span', self.__spanSamples),
+                               ('Top functions (self)', self.__selfSamples),
+                               ('Top functions (inclusive)', self.__inclusiveSamples)):
+            print( file = file )
+            print( f'{title}:', file = file )
+            print( f'{"pct":>7} {"samples":>9}  name', file = file )
+            for name, n in samples.most_common( top ):
+                print( f'{n / count:7.1%} {n:9}  {name}', file = file )
+
+
+def frameName( frame ):
+    code = frame.f_code
+    return f'{code.co_name} ({pathlib.PurePath( code.co_filename ).name}:{code.co_firstlineno})'
+
+
+def writeSpans( file: TextIO, spans: Dict[str, tuple] ):
+    print( 'Timing spans:', file = file )
+    print( f'{"calls":>10} {"total s":>10} {"mean ms":>10}  name', file = file )
+    for name, (calls, total) in sorted( spans.items(), key = lambda x: -x[1][1] ):
+        print( f'{calls:10} {total:10.3f} {total / calls * 1000:10.3f}  {name}', file = file )
+
+
+def runProfiled( func: Callable[[], int], reportPath: pathlib.Path, mode: str = 'sample' ):
+    """Runs func with timing spans enabled under given profiler and writes report, also if func fails."""
+    global recorder
+    if mode not in profilerModes:
+        raise ValueError( f'unknown profiler: {mode}' )
+
+    spanRecorder = SpanRecorder()
+    sampler = None
+    profile = None
+    if mode == 'sample':
+        sampler = SamplingProfiler( spanRecorder )
+    else:
+        # cProfile измеряет только главный поток
+        profile = cProfile.Profile()
+
+    recorder = spanRecorder
+    start = perf_counter()
+    try:
+        if sampler is not None:
+            sampler.start()
+            try:
+                return func()
+            finally:
+                sampler.stop()
+        else:
+            return profile.runcall( func )
+    finally:
+        wallTime = perf_counter() - start
+        recorder = None
+        with open( reportPath, mode = 'wt', encoding = 'utf-8' ) as file:
+            print( 'Command:', ' '.join( sys.argv ), file = file )
+            print( f'Wall time: {wallTime:.3f} s', file = file )
+            print( file = file )
+            writeSpans( file, spanRecorder.stats() )
+            print( file = file )
+            if sampler is not None:
+                sampler.writeReport( file, wallTime )
+            else:
+                pstats.Stats( profile, stream = file ).sort_stats( 'cumulative' ).print_stats( 40 )
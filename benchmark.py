@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import argparse
+import hashlib
+import os
+import pathlib
+import tempfile
+import time
+
+import FileDb
+
+
+def main():
+    parser = argparse.ArgumentParser( description = 'Photo archive benchmarks' )
+    benchmarks = parser.add_subparsers( help = 'available benchmarks' )
+    parser.set_defaults( execute = None )
+
+    configureParseBenchmark( benchmarks.add_parser( 'parse', help = 'checksum index parse rate' ) )
+    configureHashBenchmark( benchmarks.add_parser( 'hash', help = 'large file hashing throughput' ) )
+    configureDuplicatesBenchmark( benchmarks.add_parser( 'duplicates', help = 'load and lookup of duplicated content' ) )
+
+    cmdArgs = parser.parse_args()
+
+    execute = cmdArgs.execute
+    if execute is None:
+        parser.error( 'No benchmark is given.' )
+
+    return execute( cmdArgs )
+
+
+def measure( name: str, count: int, unit: str, func, *args ):
+    start = time.perf_counter()
+    func( *args )
+    elapsed = time.perf_counter() - start
+    print( f'{name}: {elapsed:.3f} s, {count / elapsed:,.0f} {unit}/s' )
+    return elapsed
+
+
+def configureParseBenchmark( parser: argparse.ArgumentParser ):
+    parser.set_defaults( execute = parseBenchmarkMain )
+    parser.add_argument( '--entries', help = 'number of generated index entries',
+                         type = int, default = 1000000 )
+    parser.add_argument( 'CHECKSUM_FILE', nargs = '?', type = pathlib.Path, default = None,
+                         help = 'existing checksum file to parse instead of generated one' )
+
+
+def parseBenchmarkMain( cmdArgs ):
+    checksumFile = cmdArgs.CHECKSUM_FILE
+    if checksumFile is not None:
+        return runParseBenchmark( checksumFile )
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        checksumFile = pathlib.Path( tempDir ).joinpath( 'Checksums.sha2' )
+        with checksumFile.open( mode = 'wt', encoding = 'utf-8' ) as file:
+            for i in range( cmdArgs.entries ):
+                c = hashlib.sha256( i.to_bytes( 8, 'little' ) ).hexdigest()
+                print( f'{c} *./{i % 1000:03}/IMG_{i:07}.JPG', file = file )
+
+        return runParseBenchmark( checksumFile )
+
+
+def runParseBenchmark( checksumFile: pathlib.Path ):
+    with FileDb.ChecksumFileReader( checksumFile ) as reader:
+        count = sum( 1 for _ in reader )
+
+    def readLines():
+        with FileDb.ChecksumFileReader( checksumFile ) as r:
+            for _ in r:
+                pass
+
+    def readBatches():
+        with FileDb.ChecksumFileReader( checksumFile ) as r:
+            for _ in r.readBatches():
+                pass
+
+    def loadDb():
+        FileDb.FileDb().addChecksumFile( None, checksumFile )
+
+    lineTime = measure( 'line reader', count, 'lines', readLines )
+    batchTime = measure( 'batch reader', count, 'lines', readBatches )
+    measure( 'FileDb load', count, 'lines', loadDb )
+    print( f'batch reader speedup: {lineTime / batchTime:.1f}x' )
+
+
+def configureHashBenchmark( parser: argparse.ArgumentParser ):
+    parser.set_defaults( execute = hashBenchmarkMain )
+    parser.add_argument( '--size', help = 'size of generated file in MB',
+                         type = int, default = 1024 )
+    parser.add_argument( 'FILE', nargs = '?', type = pathlib.Path, default = None,
+                         help = 'existing large file to hash instead of generated one' )
+
+
+def hashBenchmarkMain( cmdArgs ):
+    filePath = cmdArgs.FILE
+    if filePath is not None:
+        return runHashBenchmark( filePath )
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        filePath = pathlib.Path( tempDir ).joinpath( 'large.bin' )
+        block = os.urandom( 0x100000 )
+        with filePath.open( mode = 'wb' ) as file:
+            for _ in range( cmdArgs.size ):
+                file.write( block )
+
+        return runHashBenchmark( filePath )
+
+
+def dropFileCache( filePath: pathlib.Path ):
+    # без вытеснения из кэша измеряется только скорость хеширования
+    if not hasattr( os, 'posix_fadvise' ):
+        return
+
+    fd = os.open( str( filePath ), os.O_RDONLY )
+    try:
+        os.fdatasync( fd )
+        os.posix_fadvise( fd, 0, 0, os.POSIX_FADV_DONTNEED )
+    finally:
+        os.close( fd )
+
+
+def runHashBenchmark( filePath: pathlib.Path ):
+    size = filePath.stat().st_size / 0x100000
+
+    def hashSerial():
+        FileDb.calculateChecksums( filePath, (FileDb.defaultChecksumAlgorithm,), overlapped = False )
+
+    def hashOverlapped():
+        FileDb.calculateChecksums( filePath, (FileDb.defaultChecksumAlgorithm,), overlapped = True )
+
+    dropFileCache( filePath )
+    serialTime = measure( 'serial read/hash', size, 'MB', hashSerial )
+    dropFileCache( filePath )
+    overlappedTime = measure( 'overlapped read/hash', size, 'MB', hashOverlapped )
+    print( f'overlapped speedup: {serialTime / overlappedTime:.2f}x' )
+
+
+def configureDuplicatesBenchmark( parser: argparse.ArgumentParser ):
+    parser.set_defaults( execute = duplicatesBenchmarkMain )
+    parser.add_argument( '--entries', help = 'number of database entries',
+                         type = int, default = 100000 )
+    parser.add_argument( '--groups', help = 'number of distinct checksums',
+                         type = int, default = 10 )
+    parser.add_argument( '--lookups', help = 'number of best match lookups',
+                         type = int, default = 10000 )
+
+
+def duplicatesBenchmarkMain( cmdArgs ):
+    entries = cmdArgs.entries
+    checksums = [hashlib.sha256( i.to_bytes( 8, 'little' ) ).hexdigest() for i in range( cmdArgs.groups )]
+    db = FileDb.FileDb()
+
+    def load():
+        for i in range( entries ):
+            db.addFile( f'{i % 1000:03}/IMG_{i:07}.JPG', checksums[i % len( checksums )] )
+
+    lookups = [(checksums[i % len( checksums )], pathlib.Path( f'IMG_{(i * 7919) % entries:07}.jpg' ))
+               for i in range( cmdArgs.lookups )]
+
+    def findBestMatch():
+        for c, filePath in lookups:
+            db.get( c ).findBestMatch( filePath )
+
+    def walkChain():
+        # прежний поиск: проход по всей цепочке дубликатов
+        for c, filePath in lookups:
+            fileName = filePath.name.lower()
+            f = db.get( c )
+            while f is not None and f.filePath.name.lower() != fileName:
+                f = f.duplicate
+
+    measure( 'FileDb load', entries, 'entries', load )
+    walkTime = measure( 'chain walk', len( lookups ), 'lookups', walkChain )
+    matchTime = measure( 'best match', len( lookups ), 'lookups', findBestMatch )
+    print( f'best match speedup: {walkTime / matchTime:.1f}x' )
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    exit( main() or 0 )
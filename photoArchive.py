@@ -1,28 +1,46 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 import argparse
-import fnmatch
+import errno
+import functools
+import io
+import os
 import pathlib
-import re
+import secrets
 import shutil
 import stat
+from collections import deque
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
 from sys import stderr
-from typing import Callable, Set, Dict, Optional, List, Pattern
+from typing import Callable, Deque, Set, Dict, Optional, List
 
 import FileDb
+import Profiler
 
 
 def main():
     parser = argparse.ArgumentParser( description = 'Photo archive tool' )
     commands = parser.add_subparsers( help = 'available commands' )
     parser.set_defaults( execute = None )
+    parser.add_argument( '--profile', help = 'write profiling report with timing spans to file',
+                         type = pathlib.Path, default = None )
+    parser.add_argument( '--profiler', help = 'sampling profiler with bounded overhead or cProfile (main thread only)',
+                         choices = Profiler.profilerModes, default = 'sample' )
 
     configureFindCommand( commands.add_parser( 'find', help = 'lookup file tree in photo database' ) )
     configureIndexCommand( commands.add_parser( 'index', help = 'create or verify photo database index' ) )
     configureCheckDuplicatesCommand( commands.add_parser(
         'check-duplicates', help = 'check that files with identical checksums are identical' ) )
+    configureDedupeCommand( commands.add_parser(
+        'dedupe', help = 'replace verified duplicates with hardlinks or reflinks' ) )
     configureRestoreCommand( commands.add_parser(
         'restore', help = 'restore files in indexed location from another database' ) )
+    configureCompareCommand( commands.add_parser(
+        'compare', help = 'compare two indexed trees using folder digests' ) )
+    configureMirrorCommand( commands.add_parser(
+        'mirror', help = 'synchronize indexed replica with indexed source tree' ) )
+    configureIngestCommand( commands.add_parser(
+        'ingest', help = 'copy new files into indexed storage reading each file once' ) )
 
     cmdArgs = parser.parse_args()
 
@@ -30,7 +48,10 @@ def main():
     if execute is None:
         parser.error( 'No command is given.' )
 
-    return execute( cmdArgs )
+    if cmdArgs.profile is None:
+        return execute( cmdArgs )
+
+    return Profiler.runProfiled( lambda: execute( cmdArgs ), cmdArgs.profile, cmdArgs.profiler )
 
 
 def createFileTreeIterator( _cmdArgs ):
@@ -39,13 +60,15 @@ def createFileTreeIterator( _cmdArgs ):
     return iterator
 
 
-FindActionType = Callable[[pathlib.Path, pathlib.Path, FileDb.FileInfo], None]
+# базовая папка, относительный путь, найденный файл, вычисленные чек-суммы
+FindActionType = Callable[[pathlib.Path, pathlib.Path, Optional[FileDb.FileInfo], Dict[str, str]], None]
 
 
 def configureFindCommand( findParser: argparse.ArgumentParser ):
     findParser.set_defaults( execute = findCmdMain )
     findParser.add_argument( '--db', required = True, action = 'append',
                              type = pathlib.Path, help = 'photo database' )
+    addDbCacheArgument( findParser )
     findActionGroup = findParser.add_mutually_exclusive_group()
     findActionGroup.add_argument( '--print', help = 'print files and storage location',
                                   action = 'store_true' )
@@ -62,61 +85,106 @@ def configureFindCommand( findParser: argparse.ArgumentParser ):
                              type = pathlib.Path, help = 'path prefix to remove from cached checksums' )
     findParser.add_argument( '--excluded-list', dest = 'excludedList',
                              type = pathlib.Path, help = 'file with excluded paths and patterns' )
+    addStreamsPerDeviceArgument( findParser )
+    addResultFormatArgument( findParser )
+    findParser.add_argument( '--bloom', help = 'load indexes only on Bloom filter hits',
+                             action = 'store_true' )
+    findParser.add_argument( '--merged-bloom', help = 'Bloom filter for all database indexes (implies --bloom)',
+                             type = pathlib.Path, dest = 'mergedBloom', default = None )
+    findParser.add_argument( '--jobs', help = 'number of files hashed ahead of the find action',
+                             type = int, default = 16 )
     findParser.add_argument( 'FILES', nargs = argparse.REMAINDER,
                              type = pathlib.Path, help = 'files or folders to find' )
 
 
-def findCmdMain( cmdArgs ):
-    db = FileDb.FileDb()
-    for dbPath in cmdArgs.db:
-        db.addIndexedTree( dbPath )
+def addDbCacheArgument( parser: argparse.ArgumentParser ):
+    parser.add_argument( '--db-cache', help = 'SQLite file to keep loaded database indexes on disk',
+                         type = pathlib.Path, dest = 'dbCache', default = None )
+
+
+def createFileDb( cmdArgs ):
+    if cmdArgs.dbCache is None:
+        return FileDb.FileDb()
+
+    return FileDb.SqliteFileDb( cmdArgs.dbCache )
+
+
+def addResultFormatArgument( parser: argparse.ArgumentParser ):
+    parser.add_argument( '--format', help = 'result output format: text, NUL separated status, path and target '
+                                            'or JSON lines with checksums',
+                         choices = FileDb.resultFormats, dest = 'resultFormat', default = 'text' )
 
+
+def addStreamsPerDeviceArgument( parser: argparse.ArgumentParser ):
+    parser.add_argument( '--streams-per-device', help = 'number of parallel read streams per disk device',
+                         type = int, dest = 'streamsPerDevice', default = 1 )
+
+
+def findCmdMain( cmdArgs ):
     processNew = cmdArgs.new
+    results = FileDb.createResultSink( cmdArgs.resultFormat )
 
     if cmdArgs.moveTarget is not None:
         action = CopyFindAction( target = cmdArgs.moveTarget, move = True, new = processNew )
     elif cmdArgs.copyTarget is not None:
         action = CopyFindAction( target = cmdArgs.copyTarget, move = False, new = processNew )
     elif processNew:
-        action = printOnlyNewFindAction if cmdArgs.ignoreRenames else printNewFindAction
+        action = functools.partial( printOnlyNewFindAction if cmdArgs.ignoreRenames else printNewFindAction,
+                                    results )
     else:
-        action = printFindAction
+        action = functools.partial( printFindAction, results )
 
-    cmd = FindCommand( action = action, db = db,
-                       fileTreeIterator = createFileTreeIterator( cmdArgs ) )
+    if cmdArgs.bloom or cmdArgs.mergedBloom is not None:
+        if cmdArgs.dbCache is not None:
+            raise ValueError( 'Bloom filters can not be used with database cache' )
 
-    if cmdArgs.excludedList is not None:
-        cmd.addExcludedList( cmdArgs.excludedList )
-
-    cachedChecksums = cmdArgs.cachedChecksums
-    files = cmdArgs.FILES
-    if len( files ) == 0 and cachedChecksums is not None:
-        cmd.processChecksumFile( cachedChecksums, cmdArgs.cachedChecksumsRoot )
+        db = FileDb.FilteredFileDb( cmdArgs.mergedBloom )
     else:
-        if len( files ) == 0:
-            files = [pathlib.Path()]
+        db = createFileDb( cmdArgs )
+
+    with db, results, \
+            FileDb.ChecksumScheduler( streamsPerDevice = cmdArgs.streamsPerDevice ) as checksumScheduler:
+        for dbPath in cmdArgs.db:
+            db.addIndexedTree( dbPath )
 
-        if cachedChecksums is not None:
-            cmd.addCachedChecksums( cachedChecksums, cmdArgs.cachedChecksumsRoot )
+        cmd = FindCommand( action = action, db = db,
+                           fileTreeIterator = createFileTreeIterator( cmdArgs ),
+                           checksumScheduler = checksumScheduler, jobs = cmdArgs.jobs )
 
-        for filePath in files:
-            cmd.process( filePath )
+        if cmdArgs.excludedList is not None:
+            cmd.addExcludedList( cmdArgs.excludedList )
+
+        cachedChecksums = cmdArgs.cachedChecksums
+        files = cmdArgs.FILES
+        if len( files ) == 0 and cachedChecksums is not None:
+            cmd.processChecksumFile( cachedChecksums, cmdArgs.cachedChecksumsRoot )
+        else:
+            if len( files ) == 0:
+                files = [pathlib.Path()]
+
+            if cachedChecksums is not None:
+                cmd.addCachedChecksums( cachedChecksums, cmdArgs.cachedChecksumsRoot )
+
+            for filePath in files:
+                cmd.process( filePath )
 
 
 class FindCommand:
     __cachedChecksums: Dict[pathlib.Path, str]
-    __excludedPatterns: List[Pattern]
-    __excludedFiles: Set[pathlib.Path]
-    __excludedPaths: Set[pathlib.Path]
+    __exclusions: FileDb.PathExclusions
+
+    def __init__( self, *, action: FindActionType, db: FileDb.FileDb, fileTreeIterator: FileDb.FileTreeIterator,
+                  checksumScheduler: Optional[FileDb.ChecksumScheduler] = None, jobs: int = 1 ):
+        if jobs < 1:
+            raise ValueError( 'jobs must be positive' )
 
-    def __init__( self, *, action: FindActionType, db: FileDb.FileDb, fileTreeIterator: FileDb.FileTreeIterator ):
         self.__db = db
         self.__action = action
         self.__fileTreeIterator = fileTreeIterator
+        self.__checksumScheduler = checksumScheduler
+        self.__jobs = jobs
         self.__cachedChecksums = dict()
-        self.__excludedPatterns = list()
-        self.__excludedFiles = set()
-        self.__excludedPaths = set()
+        self.__exclusions = FileDb.PathExclusions()
 
     def addCachedChecksums( self, checksumFile: pathlib.Path, filterPath: Optional[pathlib.Path] ):
         with FileDb.ChecksumFileReader( checksumFile ) as reader:
@@ -147,43 +215,74 @@ class FindCommand:
 
                 if (not '/' in l) and (not '\\' in l):
                     # Только имя файла - это исключающий шаблон
-                    self.__excludedPatterns.append( re.compile(
-                        fnmatch.translate( path.name ), re.RegexFlag.IGNORECASE | re.RegexFlag.DOTALL ) )
+                    self.__exclusions.addPattern( path.name )
                 elif l.endswith( '/' ) or l.endswith( '\\' ):
                     # префикс пути
-                    self.__excludedPaths.add( path )
+                    self.__exclusions.addFolder( path )
                 else:
                     # точное имя файла
-                    self.__excludedFiles.add( path )
+                    self.__exclusions.addFile( path )
 
     def process( self, filePath: pathlib.Path ):
         s = filePath.stat()
         if not stat.S_ISDIR( s.st_mode ):
             self.processFile( filePath.parent, filePath )
+        elif self.__checksumScheduler is None:
+            # исключённые папки не обходятся
+            for relativePath in self.__fileTreeIterator.iterate( filePath, self.__exclusions ):
+                self.__action( filePath, relativePath, *self.__findFile( filePath, relativePath ) )
         else:
-            for relativePath in self.__fileTreeIterator.iterate( filePath ):
-                self.processFile( filePath, relativePath )
+            self.__processScheduled( filePath )
+
+    def __processScheduled( self, basePath: pathlib.Path ):
+        # Конвейер: обход дерева пачками по jobs файлов передаётся на вычисление чек-сумм,
+        # действия выполняются в порядке обхода, пока вычисляется следующая пачка.
+        jobs = self.__jobs
+        pending = deque()
+        batch = list()
+        try:
+            for relativePath in self.__fileTreeIterator.iterate( basePath, self.__exclusions ):
+                batch.append( relativePath )
+                if len( batch ) < jobs:
+                    continue
 
-    def isExcluded( self, filePath: pathlib.Path ):
-        if filePath in self.__excludedFiles:
-            return True
+                self.__scheduleBatch( basePath, batch, pending )
+                batch = list()
+                while len( pending ) > jobs:
+                    self.__completeNext( basePath, pending )
 
-        excludedPaths = self.__excludedPaths
-        if len( excludedPaths ) > 0:
-            for p in filePath.parents:
-                if p in excludedPaths:
-                    return True
+            self.__scheduleBatch( basePath, batch, pending )
+            while len( pending ) > 0:
+                self.__completeNext( basePath, pending )
+        finally:
+            for _, f in pending:
+                f.cancel()
 
-        name = filePath.name
-        for p in self.__excludedPatterns:
-            if p.match( name ):
-                return True
+    def __scheduleBatch( self, basePath: pathlib.Path, batch: List[pathlib.Path], pending: Deque ):
+        if len( batch ) == 0:
+            return
 
-        return False
+        requests = list()
+        algorithms = self.__db.algorithms
+        for relativePath in batch:
+            if relativePath in self.__cachedChecksums:
+                requests.append( (basePath.joinpath( relativePath ), ()) )
+            else:
+                requests.append( (basePath.joinpath( relativePath ), algorithms) )
+
+        pending.extend( zip( batch, self.__checksumScheduler.schedule( requests ) ) )
+
+    def __completeNext( self, basePath: pathlib.Path, pending: Deque ):
+        relativePath, checksums = pending.popleft()
+        self.__action( basePath, relativePath,
+                       *self.__findScheduledFile( basePath, relativePath, checksums.result() ) )
+
+    def isExcluded( self, filePath: pathlib.Path ):
+        return self.__exclusions.isFileExcluded( filePath )
 
     def processFile( self, basePath: pathlib.Path, filePath: pathlib.Path ):
         if not self.isExcluded( filePath ):
-            self.__action( basePath, filePath, self.__findFile( basePath, filePath ) )
+            self.__action( basePath, filePath, *self.__findFile( basePath, filePath ) )
 
     def processChecksumFile( self, cachedChecksums: pathlib.Path, filterPath: Optional[pathlib.Path] ):
         with FileDb.ChecksumFileReader( cachedChecksums ) as reader:
@@ -196,12 +295,21 @@ class FindCommand:
                         continue
 
                 if not self.isExcluded( fp ):
-                    self.__action( basePath, fp, self.__findFileByChecksum( fp, c ) )
+                    self.__action( basePath, fp, *self.__findFileByChecksum( fp, c ) )
 
     def __findFile( self, basePath: pathlib.Path, filePath: pathlib.Path ):
         cachedChecksum = self.__cachedChecksums.get( filePath, None )
         if cachedChecksum is None:
-            return self.__db.findFile( basePath.joinpath( filePath ) )
+            # все чек-суммы вычисляются за одно чтение и передаются действию
+            checksums = FileDb.calculateChecksums( basePath.joinpath( filePath ), self.__db.algorithms )
+            return self.__db.findFileByChecksums( basePath.joinpath( filePath ), checksums ), checksums
+        else:
+            return self.__findFileByChecksum( filePath, cachedChecksum )
+
+    def __findScheduledFile( self, basePath: pathlib.Path, filePath: pathlib.Path, checksums: Dict[str, str] ):
+        cachedChecksum = self.__cachedChecksums.get( filePath, None )
+        if cachedChecksum is None:
+            return self.__db.findFileByChecksums( basePath.joinpath( filePath ), checksums ), checksums
         else:
             return self.__findFileByChecksum( filePath, cachedChecksum )
 
@@ -209,28 +317,42 @@ class FindCommand:
         fileInfo = self.__db.get( checksum )
         if fileInfo is not None:
             fileInfo = fileInfo.findBestMatch( filePath )
-        return fileInfo
+        return fileInfo, { FileDb.detectChecksumAlgorithm( checksum ): checksum }
 
 
-def printFindAction( _basePath: pathlib.Path, filePath: pathlib.Path, fileInfo: FileDb.FileInfo ):
+def preferredChecksum( checksums: Dict[str, str] ):
+    checksum = checksums.get( FileDb.defaultChecksumAlgorithm, None )
+    if checksum is None and len( checksums ) > 0:
+        checksum = next( iter( checksums.values() ) )
+
+    return checksum
+
+
+def printFindAction( results: FileDb.ResultSink,
+                     _basePath: pathlib.Path, filePath: pathlib.Path, fileInfo: Optional[FileDb.FileInfo],
+                     checksums: Dict[str, str] ):
     if fileInfo is None:
-        foundName = '-'
+        results.write( 'n', filePath, checksum = preferredChecksum( checksums ), text = f"{filePath} -" )
     else:
-        foundName = fileInfo.filePath
-
-    print( f"{filePath} {foundName}" )
+        results.write( 'f', filePath, target = fileInfo.filePath, checksum = fileInfo.checksum,
+                       text = f"{filePath} {fileInfo.filePath}" )
 
 
-def printNewFindAction( _basePath: pathlib.Path, filePath: pathlib.Path, fileInfo: FileDb.FileInfo ):
+def printNewFindAction( results: FileDb.ResultSink,
+                        _basePath: pathlib.Path, filePath: pathlib.Path, fileInfo: Optional[FileDb.FileInfo],
+                        checksums: Dict[str, str] ):
     if fileInfo is not None and fileInfo.filePath.name.lower() != filePath.name.lower():
-        print( f"{filePath} {fileInfo.filePath}" )
+        results.write( 'r', filePath, target = fileInfo.filePath, checksum = fileInfo.checksum,
+                       text = f"{filePath} {fileInfo.filePath}" )
     if fileInfo is None:
-        print( filePath )
+        results.write( 'n', filePath, checksum = preferredChecksum( checksums ), text = str( filePath ) )
 
 
-def printOnlyNewFindAction( _basePath: pathlib.Path, filePath: pathlib.Path, fileInfo: FileDb.FileInfo ):
+def printOnlyNewFindAction( results: FileDb.ResultSink,
+                            _basePath: pathlib.Path, filePath: pathlib.Path, fileInfo: Optional[FileDb.FileInfo],
+                            checksums: Dict[str, str] ):
     if fileInfo is None:
-        print( filePath )
+        results.write( 'n', filePath, checksum = preferredChecksum( checksums ), text = str( filePath ) )
 
 
 class MkDirCache:
@@ -254,7 +376,8 @@ class CopyFindAction:
         self.__new = new
         self.__dirCache = MkDirCache()
 
-    def __call__( self, basePath: pathlib.Path, filePath: pathlib.Path, fileInfo: FileDb.FileInfo ):
+    def __call__( self, basePath: pathlib.Path, filePath: pathlib.Path, fileInfo: Optional[FileDb.FileInfo],
+                  _checksums: Dict[str, str] ):
         if fileInfo is not None:
             if self.__new:
                 return
@@ -279,8 +402,9 @@ class CopyFindAction:
         if self.__move:
             sourcePath.rename( targetPath )
         else:
-            # noinspection PyTypeChecker
-            shutil.copy2( sourcePath, targetPath )
+            with Profiler.span( 'copy' ):
+                # noinspection PyTypeChecker
+                shutil.copy2( sourcePath, targetPath )
 
 
 def configureIndexCommand( indexParser: argparse.ArgumentParser ):
@@ -293,6 +417,8 @@ def configureIndexCommand( indexParser: argparse.ArgumentParser ):
                                    action = 'store_const', dest = 'indexAction', const = 'update' )
     indexActionGroup.add_argument( '--verify', help = 'verify file checksum index',
                                    action = 'store_const', dest = 'indexAction', const = 'verify' )
+    indexActionGroup.add_argument( '--migrate-sha1', help = 'replace SHA1 indexes found in folders with verified SHA2 ones',
+                                   action = 'store_const', dest = 'indexAction', const = 'migrate' )
     indexParser.add_argument( '--checksum-file', help = 'checksum file',
                               type = pathlib.Path, dest = 'checksumFile', default = None )
     indexParser.add_argument( '--changes-mode', help = 'context changes handling mode',
@@ -300,6 +426,17 @@ def configureIndexCommand( indexParser: argparse.ArgumentParser ):
                               dest = 'changesMode' )
     indexParser.add_argument( '--reuse-checksums', help = 'do not recalculate checksums for files already in index',
                               action = 'store_true', dest = 'reuseChecksums' )
+    addStreamsPerDeviceArgument( indexParser )
+    addResultFormatArgument( indexParser )
+    indexParser.add_argument( '--index-version', help = 'created index file version, 2 is sorted block format '
+                                                    '(default: version of existing index or 1)',
+                              type = int, choices = FileDb.indexVersions, dest = 'indexVersion', default = None )
+    indexParser.add_argument( '--jobs', help = 'number of folders processed concurrently',
+                              type = int, default = 1 )
+    indexParser.add_argument( '--bloom', help = 'write Bloom filter next to created index',
+                              action = 'store_true' )
+    indexParser.add_argument( '--merged-bloom', help = 'write Bloom filter for all indexes in given folders',
+                              type = pathlib.Path, dest = 'mergedBloom', default = None )
     indexParser.add_argument( 'FOLDERS', nargs = argparse.REMAINDER,
                               type = pathlib.Path, help = 'folders to index' )
 
@@ -314,6 +451,15 @@ def indexCmdMain( cmdArgs ):
     if len( folders ) == 0:
         folders = [pathlib.Path()]
 
+    migrate = cmdArgs.indexAction == 'migrate'
+    if migrate:
+        if indexFileName is not None:
+            raise ValueError( 'checksum file cannot be specified for migration' )
+        if cmdArgs.reuseChecksums:
+            raise ValueError( 'checksums cannot be reused for migration' )
+
+        folders = findSha1IndexedFolders( folders )
+
     fileTreeIterator = createFileTreeIterator( cmdArgs )
 
     create = cmdArgs.indexAction != 'verify'
@@ -322,29 +468,112 @@ def indexCmdMain( cmdArgs ):
     rejectChanges = create and cmdArgs.changesMode == 'reject'
     reviewChanges = create and cmdArgs.changesMode == 'review'
 
+    jobs = cmdArgs.jobs
     success = True
     try:
-        for folder in folders:
-            indexBuilder = FileDb.IndexBuilder( folder = folder, indexFileName = indexFileName,
-                                                fileTreeIterator = fileTreeIterator,
-                                                create = create, verify = verify,
-                                                rejectChanges = rejectChanges, reviewChanges = reviewChanges,
-                                                reuseChecksums = cmdArgs.reuseChecksums )
-
-            if not indexBuilder.run():
-                success = False
+        with FileDb.ChecksumScheduler( streamsPerDevice = cmdArgs.streamsPerDevice ) as checksumScheduler:
+            indexBuilders = list()
+            for folder in folders:
+                indexBuilders.append( FileDb.IndexBuilder(
+                    folder = folder, indexFileName = indexFileName,
+                    fileTreeIterator = fileTreeIterator,
+                    create = create, verify = verify,
+                    rejectChanges = rejectChanges, reviewChanges = reviewChanges,
+                    reuseChecksums = cmdArgs.reuseChecksums,
+                    checksumScheduler = checksumScheduler,
+                    output = io.StringIO() if jobs > 1 else None,
+                    bloomFilter = cmdArgs.bloom,
+                    backupOldIndex = migrate,
+                    resultFormat = cmdArgs.resultFormat,
+                    indexVersion = cmdArgs.indexVersion ) )
+
+            if jobs > 1:
+                success = runIndexBuildersConcurrently( indexBuilders, jobs, progress = migrate )
+            else:
+                for n, indexBuilder in enumerate( indexBuilders, 1 ):
+                    if not indexBuilder.run():
+                        success = False
+                    if migrate:
+                        printProgress( n, len( indexBuilders ), indexBuilder )
 
     except FileDb.IndexValidationError as e:
         print( e, file = stderr )
         return 2
 
+    if cmdArgs.mergedBloom is not None:
+        writeMergedBloomFilter( folders, cmdArgs.mergedBloom )
+
     return 0 if success else 1
 
 
+def findSha1IndexedFolders( folders: List[pathlib.Path] ):
+    # корни индексов ищутся так же, как при загрузке базы
+    sha1Folders = list()
+    for folder in folders:
+        for relativePath, indexFile in FileDb.iterateIndexFiles( folder, pathlib.Path() ):
+            if indexFile.suffix == '.sha1':
+                sha1Folders.append( folder.joinpath( relativePath ) )
+
+    return sha1Folders
+
+
+def printProgress( done: int, total: int, indexBuilder: FileDb.IndexBuilder ):
+    print( f'[{done}/{total}] {indexBuilder.folderName}', file = stderr, flush = True )
+
+
+def writeMergedBloomFilter( folders: List[pathlib.Path], filePath: pathlib.Path ):
+    checksums = list()
+    sources = list()
+    for folder in folders:
+        for _, indexFile in FileDb.iterateIndexFiles( folder, pathlib.Path() ):
+            # состояние запоминается до чтения, изменённый позже индекс сделает фильтр недействительным
+            sources.append( FileDb.indexFileState( indexFile ) )
+            with FileDb.ChecksumFileReader( indexFile ) as reader:
+                for batch in reader.readBatches():
+                    checksums.extend( c for _, c in batch )
+
+    FileDb.createBloomFilter( checksums, sources ).save( filePath )
+
+
+def runIndexBuildersConcurrently( indexBuilders: List[FileDb.IndexBuilder], jobs: int,
+                                 progress: bool = False ):
+    success = True
+    error = None
+    done = 0
+    with ThreadPoolExecutor( max_workers = jobs ) as executor:
+        futures = { executor.submit( b.run ): b for b in indexBuilders }
+        for future in as_completed( futures ):
+            try:
+                if not future.result():
+                    success = False
+            except (CancelledError, FileDb.IndexBuildCancelled):
+                # отчёт прерванной папки не выводится
+                continue
+            except Exception as e:
+                if error is None:
+                    # как и при последовательной обработке, остальные папки не обрабатываются
+                    error = e
+                    for f, b in futures.items():
+                        f.cancel()
+                        b.cancel()
+
+            # отчёт папки выводится целиком
+            print( futures[future].output.getvalue(), end = '', flush = True )
+            done += 1
+            if progress:
+                printProgress( done, len( futures ), futures[future] )
+
+    if error is not None:
+        raise error
+
+    return success
+
+
 def configureCheckDuplicatesCommand( indexParser: argparse.ArgumentParser ):
     indexParser.set_defaults( execute = checkDuplicatesCmdMain )
     indexParser.add_argument( '--storage-base', help = 'base path of indexed file storage',
                               type = pathlib.Path, dest = 'storageBase', default = None )
+    addDbCacheArgument( indexParser )
     indexParser.add_argument( 'FOLDERS', nargs = argparse.REMAINDER,
                               type = pathlib.Path, help = 'photo database root folders' )
 
@@ -354,27 +583,27 @@ def checkDuplicatesCmdMain( cmdArgs ):
     if len( folders ) == 0:
         folders = [pathlib.Path()]
 
-    db = FileDb.FileDb()
-    for dbPath in folders:
-        db.addIndexedTree( pathlib.Path(), dbPath )
+    with createFileDb( cmdArgs ) as db:
+        for dbPath in folders:
+            db.addIndexedTree( pathlib.Path(), dbPath )
 
-    storageBase = cmdArgs.storageBase
+        storageBase = cmdArgs.storageBase
 
-    duplicates = list()
-    for _, fileInfo in db.entries():
-        if fileInfo.duplicate is not None:
-            duplicates.append( fileInfo )
+        duplicates = list()
+        for _, fileInfo in db.entries():
+            if fileInfo.duplicate is not None:
+                duplicates.append( fileInfo )
 
-    success = True
-    for fileInfo in sorted( duplicates, key = lambda x: x.id ):
-        duplicate = fileInfo.duplicate
-        while duplicate is not None:
-            if not checkDuplicates( storageBase, fileInfo, duplicate ):
-                success = False
-                print( f"'{fileInfo.filePath}' and '{duplicate.filePath}' are binary different" )
-            duplicate = duplicate.duplicate
+        success = True
+        for fileInfo in sorted( duplicates, key = lambda x: x.id ):
+            duplicate = fileInfo.duplicate
+            while duplicate is not None:
+                if not checkDuplicates( storageBase, fileInfo, duplicate ):
+                    success = False
+                    print( f"'{fileInfo.filePath}' and '{duplicate.filePath}' are binary different" )
+                duplicate = duplicate.duplicate
 
-    return 0 if success else 1
+        return 0 if success else 1
 
 
 def checkDuplicates( storageBase: Optional[pathlib.Path], fileInfo: FileDb.FileInfo, duplicate: FileDb.FileInfo ):
@@ -399,10 +628,156 @@ def checkDuplicates( storageBase: Optional[pathlib.Path], fileInfo: FileDb.FileI
     return True
 
 
+def configureDedupeCommand( dedupeParser: argparse.ArgumentParser ):
+    dedupeParser.set_defaults( execute = dedupeCmdMain )
+    dedupeParser.add_argument( '--storage-base', help = 'base path of indexed file storage',
+                               type = pathlib.Path, dest = 'storageBase', default = None )
+    dedupeParser.add_argument( '--method', help = 'how duplicates share data',
+                               choices = ['hardlink', 'reflink'], default = 'hardlink' )
+    dedupeParser.add_argument( '--dry-run', help = 'only print duplicates to be replaced',
+                               action = 'store_true', dest = 'dryRun' )
+    addDbCacheArgument( dedupeParser )
+    dedupeParser.add_argument( 'FOLDERS', nargs = argparse.REMAINDER,
+                               type = pathlib.Path, help = 'photo database root folders' )
+
+
+def dedupeCmdMain( cmdArgs ):
+    folders = cmdArgs.FOLDERS
+    if len( folders ) == 0:
+        folders = [pathlib.Path()]
+
+    with createFileDb( cmdArgs ) as db:
+        for dbPath in folders:
+            db.addIndexedTree( pathlib.Path(), dbPath )
+
+        cmd = DedupeCommand( storageBase = cmdArgs.storageBase, method = cmdArgs.method, dryRun = cmdArgs.dryRun )
+        duplicates = [fileInfo for _, fileInfo in db.entries() if fileInfo.duplicate is not None]
+        success = True
+        for fileInfo in sorted( duplicates, key = lambda x: x.id ):
+            if not cmd.process( fileInfo ):
+                success = False
+
+        print( f'reclaimed {cmd.reclaimedBytes} bytes in {cmd.replacedCount} files' )
+
+    return 0 if success else 1
+
+
+# ioctl FICLONE из linux/fs.h
+FICLONE = 0x40049409
+
+# ошибки файловых систем, не поддерживающих выбранный способ объединения
+unsupportedLinkErrors = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV)
+
+
+class DedupeCommand:
+    def __init__( self, *, storageBase: Optional[pathlib.Path], method: str, dryRun: bool ):
+        self.__storageBase = storageBase
+        self.__method = method
+        self.__dryRun = dryRun
+        self.__reclaimedBytes = 0
+        self.__replacedCount = 0
+
+    @property
+    def reclaimedBytes( self ):
+        return self.__reclaimedBytes
+
+    @property
+    def replacedCount( self ):
+        return self.__replacedCount
+
+    def process( self, fileInfo: FileDb.FileInfo ):
+        success = True
+        duplicate = fileInfo.duplicate
+        while duplicate is not None:
+            if not self.__replaceDuplicate( fileInfo, duplicate ):
+                success = False
+            duplicate = duplicate.duplicate
+
+        return success
+
+    def __fullPath( self, filePath: pathlib.Path ):
+        if self.__storageBase is not None:
+            return self.__storageBase.joinpath( filePath )
+        return filePath
+
+    def __replaceDuplicate( self, fileInfo: FileDb.FileInfo, duplicate: FileDb.FileInfo ):
+        srcPath = self.__fullPath( fileInfo.filePath )
+        dstPath = self.__fullPath( duplicate.filePath )
+
+        try:
+            srcStat = srcPath.stat()
+            dstStat = dstPath.stat()
+        except OSError as e:
+            print( f"'{duplicate.filePath}': {e}", file = stderr )
+            return False
+
+        if srcStat.st_dev != dstStat.st_dev:
+            print( f"skipping '{duplicate.filePath}', not on the same device as '{fileInfo.filePath}'" )
+            return True
+
+        if srcStat.st_ino == dstStat.st_ino:
+            # уже объединены
+            return True
+
+        if not checkDuplicates( self.__storageBase, fileInfo, duplicate ):
+            print( f"'{fileInfo.filePath}' and '{duplicate.filePath}' are binary different" )
+            return False
+
+        print( duplicate.filePath, fileInfo.filePath )
+        if not self.__dryRun:
+            try:
+                self.__link( srcPath, dstPath )
+            except OSError as e:
+                if e.errno in unsupportedLinkErrors:
+                    print( f"skipping '{duplicate.filePath}', {self.__method} is not supported: {e.strerror}",
+                           file = stderr )
+                else:
+                    print( f"'{duplicate.filePath}': {e}", file = stderr )
+                return False
+
+        # учитываются только выполненные замены
+        if self.__method == 'reflink' or dstStat.st_nlink == 1:
+            self.__reclaimedBytes += dstStat.st_size
+        self.__replacedCount += 1
+        return True
+
+    def __link( self, srcPath: pathlib.Path, dstPath: pathlib.Path ):
+        # Ссылка создаётся под временным именем и атомарно заменяет дубликат,
+        # при сбое остаётся либо исходный файл, либо ссылка.
+        temporaryPath = makeTemporaryPath( dstPath )
+        try:
+            if self.__method == 'hardlink':
+                os.link( srcPath, temporaryPath )
+            else:
+                self.__reflink( srcPath, temporaryPath )
+                # noinspection PyTypeChecker
+                shutil.copystat( dstPath, temporaryPath )
+
+            temporaryPath.replace( dstPath )
+        except BaseException:
+            try:
+                temporaryPath.unlink()
+            except OSError:
+                pass
+            raise
+
+    @staticmethod
+    def __reflink( srcPath: pathlib.Path, dstPath: pathlib.Path ):
+        try:
+            import fcntl
+        except ImportError:
+            raise OSError( errno.EOPNOTSUPP, 'reflinks are not supported on this platform' )
+
+        with srcPath.open( mode = 'rb' ) as src:
+            with dstPath.open( mode = 'xb' ) as dst:
+                fcntl.ioctl( dst.fileno(), FICLONE, src.fileno() )
+
+
 def configureRestoreCommand( restoreParser: argparse.ArgumentParser ):
     restoreParser.set_defaults( execute = restoreCmdMain )
     restoreParser.add_argument( '--db', required = True, action = 'append',
                                 type = pathlib.Path, help = 'photo database' )
+    addDbCacheArgument( restoreParser )
     restoreParser.add_argument( '--db-storage', help = 'path to storage of indexed files',
                                 type = pathlib.Path, dest = 'dbStorage', default = None )
     restoreParser.add_argument( '--checksum-file', help = 'checksum file',
@@ -414,22 +789,22 @@ def configureRestoreCommand( restoreParser: argparse.ArgumentParser ):
 
 
 def restoreCmdMain( cmdArgs ):
-    db = FileDb.FileDb()
-    for dbPath in cmdArgs.db:
-        db.addIndexedTree( pathlib.Path(), dbPath )
+    with createFileDb( cmdArgs ) as db:
+        for dbPath in cmdArgs.db:
+            db.addIndexedTree( pathlib.Path(), dbPath )
 
-    restoreCmd = RestoreCommand( db = db,
-                                 dbStorage = cmdArgs.dbStorage,
-                                 checksumFile = cmdArgs.checksumFile,
-                                 skipExisting = cmdArgs.skipExisting )
+        restoreCmd = RestoreCommand( db = db,
+                                     dbStorage = cmdArgs.dbStorage,
+                                     checksumFile = cmdArgs.checksumFile,
+                                     skipExisting = cmdArgs.skipExisting )
 
-    folders = cmdArgs.FOLDERS
-    if len( folders ) == 0:
-        folders = [pathlib.Path()]
+        folders = cmdArgs.FOLDERS
+        if len( folders ) == 0:
+            folders = [pathlib.Path()]
 
-    success = restoreCmd.process( folders )
+        success = restoreCmd.process( folders )
 
-    return 0 if success else 1
+        return 0 if success else 1
 
 
 class RestoreCommand:
@@ -480,8 +855,565 @@ class RestoreCommand:
         if self.__dbStorage is not None:
             srcPath = self.__dbStorage.joinpath( srcPath )
 
-        # noinspection PyTypeChecker
-        shutil.copy2( srcPath, fullPath )
+        with Profiler.span( 'copy' ):
+            # noinspection PyTypeChecker
+            shutil.copy2( srcPath, fullPath )
+
+
+def configureCompareCommand( compareParser: argparse.ArgumentParser ):
+    compareParser.set_defaults( execute = compareCmdMain )
+    compareParser.add_argument( 'LEFT', type = pathlib.Path, help = 'reference indexed tree' )
+    compareParser.add_argument( 'RIGHT', type = pathlib.Path, help = 'compared indexed tree' )
+
+
+def compareCmdMain( cmdArgs ):
+    cmd = CompareCommand( left = cmdArgs.LEFT, right = cmdArgs.RIGHT )
+    return 0 if cmd.process() else 1
+
+
+class CompareCommand:
+    def __init__( self, *, left: pathlib.Path, right: pathlib.Path ):
+        self.__left = left
+        self.__right = right
+
+    def process( self ):
+        leftIndexes = dict( FileDb.iterateIndexFiles( self.__left, pathlib.Path() ) )
+        rightIndexes = dict( FileDb.iterateIndexFiles( self.__right, pathlib.Path() ) )
+
+        success = True
+        for folder in sorted( set( leftIndexes.keys() ).union( rightIndexes.keys() ) ):
+            leftIndex = leftIndexes.get( folder, None )
+            rightIndex = rightIndexes.get( folder, None )
+            if rightIndex is None:
+                print( 'm', folder.as_posix() + '/' )
+                success = False
+            elif leftIndex is None:
+                print( 'n', folder.as_posix() + '/' )
+                success = False
+            elif not self.__compareIndexes( folder, leftIndex, rightIndex ):
+                success = False
+
+        return success
+
+    @staticmethod
+    def __compareIndexes( folder: pathlib.Path, leftIndex: pathlib.Path, rightIndex: pathlib.Path ):
+        changedFolders = FileDb.findChangedFolders( FileDb.readFolderDigests( leftIndex ),
+                                                    FileDb.readFolderDigests( rightIndex ) )
+        if len( changedFolders ) == 0:
+            return True
+
+        # файлы читаются только из индексов, в которых есть изменения
+        leftFiles = CompareCommand.__readChangedFiles( leftIndex, changedFolders )
+        rightFiles = CompareCommand.__readChangedFiles( rightIndex, changedFolders )
+        for filePath in sorted( set( leftFiles.keys() ).union( rightFiles.keys() ) ):
+            leftChecksum = leftFiles.get( filePath, None )
+            rightChecksum = rightFiles.get( filePath, None )
+            if rightChecksum is None:
+                print( 'm', folder.joinpath( filePath ).as_posix() )
+            elif leftChecksum is None:
+                print( 'n', folder.joinpath( filePath ).as_posix() )
+            elif leftChecksum != rightChecksum:
+                print( 'd', folder.joinpath( filePath ).as_posix() )
+
+        return False
+
+    @staticmethod
+    def __readChangedFiles( indexFile: pathlib.Path, changedFolders: Set[pathlib.Path] ):
+        files = dict()
+        with FileDb.ChecksumFileReader( indexFile ) as reader:
+            for fp, c in reader:
+                if fp.parent in changedFolders:
+                    files[fp] = c
+
+        return files
+
+
+def makeTemporaryPath( targetPath: pathlib.Path ):
+    # имена на '@' исключаются при обходе дерева
+    return targetPath.with_name( '@' + secrets.token_hex( 4 ) + '-' + targetPath.name )
+
+
+def replaceFile( sourcePath: pathlib.Path, targetPath: pathlib.Path ):
+    try:
+        sourcePath.replace( targetPath )
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+        # разные файловые системы
+        temporaryPath = makeTemporaryPath( targetPath )
+        with Profiler.span( 'copy' ):
+            # noinspection PyTypeChecker
+            shutil.copy2( sourcePath, temporaryPath )
+        temporaryPath.replace( targetPath )
+        sourcePath.unlink()
+
+
+def configureMirrorCommand( mirrorParser: argparse.ArgumentParser ):
+    mirrorParser.set_defaults( execute = mirrorCmdMain )
+    mirrorParser.add_argument( '--delete', help = 'delete destination files missing in source',
+                               action = 'store_true' )
+    mirrorParser.add_argument( '--dry-run', help = 'only print planned changes',
+                               action = 'store_true', dest = 'dryRun' )
+    mirrorParser.add_argument( 'SOURCE', type = pathlib.Path, help = 'indexed source tree' )
+    mirrorParser.add_argument( 'DESTINATION', type = pathlib.Path, help = 'indexed replica tree' )
+
+
+def mirrorCmdMain( cmdArgs ):
+    cmd = MirrorCommand( source = cmdArgs.SOURCE, destination = cmdArgs.DESTINATION,
+                         delete = cmdArgs.delete, dryRun = cmdArgs.dryRun )
+    return 0 if cmd.process() else 1
+
+
+class MirrorCommand:
+    __sourceFiles: Dict[pathlib.Path, str]
+    __sourceIndexNames: Dict[pathlib.Path, str]
+    __sourceIndexVersions: Dict[pathlib.Path, int]
+    __destinationFiles: Dict[pathlib.Path, str]
+    __destinationIndexNames: Dict[pathlib.Path, str]
+    __destinationIndexVersions: Dict[pathlib.Path, int]
+
+    def __init__( self, *, source: pathlib.Path, destination: pathlib.Path, delete: bool, dryRun: bool ):
+        self.__source = source
+        self.__destination = destination
+        self.__delete = delete
+        self.__dryRun = dryRun
+
+        self.__sourceFiles = dict()
+        self.__sourceIndexNames = dict()
+        self.__sourceIndexVersions = dict()
+        self.__destinationFiles = dict()
+        self.__destinationIndexNames = dict()
+        self.__destinationIndexVersions = dict()
+        self.__destinationDb = FileDb.FileDb()
+        self.__mkdirCache = MkDirCache()
+
+    def process( self ):
+        self.__readIndexes( self.__source, self.__sourceFiles, self.__sourceIndexNames, self.__sourceIndexVersions,
+                            None )
+        if self.__destination.exists():
+            self.__readIndexes( self.__destination, self.__destinationFiles, self.__destinationIndexNames,
+                                self.__destinationIndexVersions, self.__destinationDb )
+
+        moves, copies, removals = self.__plan()
+        if self.__dryRun:
+            for old, new, _ in moves:
+                print( 'r', old.as_posix(), new.as_posix() )
+            for target, _ in copies:
+                print( 'c', target.as_posix() )
+            for target in removals:
+                print( 'x', target.as_posix() )
+
+            return True
+
+        files = dict( self.__destinationFiles )
+        try:
+            return self.__execute( moves, copies, removals, files )
+        finally:
+            # выполненные изменения заносятся в индексы и при ошибке
+            self.__writeIndexes( files )
+
+    @staticmethod
+    def __readIndexes( basePath: pathlib.Path, files: Dict[pathlib.Path, str], indexNames: Dict[pathlib.Path, str],
+                       indexVersions: Dict[pathlib.Path, int], db: Optional[FileDb.FileDb] ):
+        for folder, indexFile in FileDb.iterateIndexFiles( basePath, pathlib.Path() ):
+            indexNames[folder] = indexFile.name
+            with FileDb.ChecksumFileReader( indexFile ) as reader:
+                indexVersions[folder] = reader.version
+                for fp, c in reader:
+                    fp = folder.joinpath( fp )
+                    files[fp] = c
+                    if db is not None:
+                        db.addFile( fp, c )
+
+    def __plan( self ):
+        destinationFiles = self.__destinationFiles
+
+        used = set()
+        wanted = list()
+        for filePath, checksum in sorted( self.__sourceFiles.items() ):
+            if destinationFiles.get( filePath, None ) == checksum:
+                used.add( filePath )
+            else:
+                wanted.append( (filePath, checksum) )
+
+        moves = list()
+        copies = list()
+        for target, checksum in wanted:
+            # содержимое, уже имеющееся в копии под другим именем, перемещается
+            candidate = self.__findMoveCandidate( target, checksum, used )
+            if candidate is None:
+                copies.append( (target, checksum) )
+            else:
+                used.add( candidate )
+                moves.append( (candidate, target, checksum) )
+
+        removals = list()
+        if self.__delete:
+            targets = set( t for t, _ in wanted )
+            removals = [fp for fp in sorted( destinationFiles.keys() ) if fp not in used and fp not in targets]
+
+        return moves, copies, removals
+
+    def __findMoveCandidate( self, target: pathlib.Path, checksum: str, used: Set[pathlib.Path] ):
+        fileName = target.name.lower()
+        candidate = None
+        fileInfo = self.__destinationDb.get( checksum )
+        while fileInfo is not None:
+            filePath = fileInfo.filePath
+            if filePath not in used:
+                if filePath.name.lower() == fileName:
+                    return filePath
+
+                if candidate is None:
+                    candidate = filePath
+
+            fileInfo = fileInfo.duplicate
+
+        return candidate
+
+    def __execute( self, moves: List, copies: List, removals: List[pathlib.Path], files: Dict[pathlib.Path, str] ):
+        destination = self.__destination
+        success = True
+
+        # перемещаемые файлы, на место которых будут записаны другие, сначала переименовываются
+        targets = set( t for t, _ in copies ).union( t for _, t, _ in moves )
+        staged = dict()
+        try:
+            for old, _, _ in moves:
+                if old in targets:
+                    stagedPath = makeTemporaryPath( destination.joinpath( old ) )
+                    destination.joinpath( old ).rename( stagedPath )
+                    staged[old] = (stagedPath, files.pop( old ))
+
+            for old, new, checksum in moves:
+                print( 'r', old.as_posix(), new.as_posix() )
+                isStaged = old in staged
+                oldPath = staged[old][0] if isStaged else destination.joinpath( old )
+                newPath = destination.joinpath( new )
+                if not oldPath.exists():
+                    # индекс копии устарел, файл копируется из источника
+                    if not isStaged:
+                        files.pop( old, None )
+                    copies.append( (new, checksum) )
+                    continue
+
+                try:
+                    self.__mkdirCache.mkdir( newPath.parent )
+                    replaceFile( oldPath, newPath )
+                except OSError as e:
+                    print( f"'{old}': {e}", file = stderr )
+                    success = False
+                    continue
+
+                if not isStaged:
+                    # на место перемещённого временного файла уже мог быть записан другой
+                    files.pop( old, None )
+                files[new] = checksum
+
+            for target, checksum in copies:
+                print( 'c', target.as_posix() )
+                try:
+                    copied = self.__copyFile( target, checksum )
+                except OSError as e:
+                    print( f"'{target}': {e}", file = stderr )
+                    copied = False
+
+                if copied:
+                    files[target] = checksum
+                else:
+                    success = False
+
+            for target in removals:
+                print( 'x', target.as_posix() )
+                try:
+                    destination.joinpath( target ).unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print( f"'{target}': {e}", file = stderr )
+                    success = False
+                    continue
+
+                del files[target]
+        finally:
+            if not self.__restoreStaged( staged, files ):
+                success = False
+
+        return success
+
+    def __restoreStaged( self, staged: Dict[pathlib.Path, tuple], files: Dict[pathlib.Path, str] ):
+        # не перемещённые временные файлы возвращаются на прежнее место
+        success = True
+        for old, (stagedPath, checksum) in staged.items():
+            if not stagedPath.exists():
+                continue
+
+            oldPath = self.__destination.joinpath( old )
+            if old not in files and not oldPath.exists():
+                stagedPath.rename( oldPath )
+                files[old] = checksum
+            elif checksum in files.values():
+                # содержимое уже есть в копии под другим именем
+                stagedPath.unlink()
+            else:
+                print( f"warning: '{stagedPath}' could not be moved back to '{old}'", file = stderr )
+                success = False
+
+        return success
+
+    def __copyFile( self, target: pathlib.Path, checksum: str ):
+        targetPath = self.__destination.joinpath( target )
+        self.__mkdirCache.mkdir( targetPath.parent )
+
+        algorithm = FileDb.detectChecksumAlgorithm( checksum )
+        temporaryPath = makeTemporaryPath( targetPath )
+        try:
+            checksums = FileDb.copyFileWithChecksums( self.__source.joinpath( target ), temporaryPath, (algorithm,) )
+            if checksums[algorithm] != checksum:
+                print( f"'{target}' does not match source index, skipped", file = stderr )
+                temporaryPath.unlink()
+                return False
+
+            temporaryPath.replace( targetPath )
+        except BaseException:
+            try:
+                temporaryPath.unlink()
+            except OSError:
+                pass
+            raise
+
+        return True
+
+    def __writeIndexes( self, files: Dict[pathlib.Path, str] ):
+        indexNames = dict( self.__destinationIndexNames )
+        for folder, indexName in list( indexNames.items() ):
+            if self.__overlapsSourceIndex( folder ):
+                del indexNames[folder]
+                if folder not in self.__sourceIndexNames:
+                    # иначе индекс копии скрывал бы вложенные индексы источника при загрузке
+                    self.__removeIndex( self.__destination.joinpath( folder, indexName ) )
+
+        indexNames.update( self.__sourceIndexNames )
+
+        entries = { folder: dict() for folder in indexNames.keys() }
+        for filePath, checksum in files.items():
+            folder = next( (p for p in filePath.parents if p in indexNames), None )
+            if folder is None:
+                print( f"warning: '{filePath}' is not covered by any index", file = stderr )
+                continue
+
+            entries[folder][filePath.relative_to( folder )] = checksum
+
+        oldEntries = dict()
+        for filePath, checksum in self.__destinationFiles.items():
+            folder = next( (p for p in filePath.parents if p in indexNames), None )
+            if folder is not None:
+                oldEntries.setdefault( folder, dict() )[filePath.relative_to( folder )] = checksum
+
+        for folder, indexName in sorted( indexNames.items() ):
+            folderEntries = entries[folder]
+            folderPath = self.__destination.joinpath( folder )
+            if folderEntries == oldEntries.get( folder, None ) and \
+                    self.__destinationIndexNames.get( folder, None ) == indexName:
+                continue
+
+            # данные только перемещались или копировались с проверкой, повторное хеширование не требуется
+            for name in ('Checksums.sha2', 'Checksums.sha1'):
+                if name != indexName:
+                    self.__removeIndex( folderPath.joinpath( name ) )
+
+            indexFile = folderPath.joinpath( indexName )
+            if len( folderEntries ) == 0:
+                self.__removeIndex( indexFile )
+                continue
+
+            # формат индекса копии сохраняется, новый индекс создаётся в формате индекса источника
+            version = self.__destinationIndexVersions.get( folder, None ) or \
+                self.__sourceIndexVersions.get( folder, 1 )
+            self.__mkdirCache.mkdir( folderPath )
+            FileDb.writeChecksumFile( indexFile, sorted( folderEntries.items() ), version )
+            FileDb.writeFolderDigests( indexFile, FileDb.calculateFolderDigests( folderEntries.items() ) )
+
+    def __overlapsSourceIndex( self, folder: pathlib.Path ):
+        for sourceFolder in self.__sourceIndexNames.keys():
+            if folder == sourceFolder or sourceFolder in folder.parents or folder in sourceFolder.parents:
+                return True
+
+        return False
+
+    @staticmethod
+    def __removeIndex( indexFile: pathlib.Path ):
+        for filePath in (indexFile, FileDb.folderDigestsFilePath( indexFile ), FileDb.bloomFilterFilePath( indexFile )):
+            try:
+                filePath.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def configureIngestCommand( ingestParser: argparse.ArgumentParser ):
+    ingestParser.set_defaults( execute = ingestCmdMain )
+    ingestParser.add_argument( '--db', required = True, action = 'append',
+                               type = pathlib.Path, help = 'photo database' )
+    addDbCacheArgument( ingestParser )
+    ingestParser.add_argument( '--to', required = True, help = 'indexed folder to place new files to',
+                               dest = 'target', type = pathlib.Path )
+    ingestParser.add_argument( 'FILES', nargs = argparse.REMAINDER,
+                               type = pathlib.Path, help = 'files or folders to ingest' )
+
+
+def ingestCmdMain( cmdArgs ):
+    files = cmdArgs.FILES
+    if len( files ) == 0:
+        files = [pathlib.Path()]
+
+    with createFileDb( cmdArgs ) as db:
+        for dbPath in cmdArgs.db:
+            db.addIndexedTree( dbPath )
+
+        cmd = IngestCommand( db = db, target = cmdArgs.target,
+                             fileTreeIterator = createFileTreeIterator( cmdArgs ), dbPaths = cmdArgs.db )
+        success = True
+        try:
+            for filePath in files:
+                if not cmd.process( filePath ):
+                    success = False
+        finally:
+            # уже скопированные файлы заносятся в индекс и при ошибке
+            cmd.commit()
+
+    return 0 if success else 1
+
+
+class IngestCommand:
+    # файлы не больше этого размера читаются в память и записываются, только если их нет в базе
+    bufferedFileSize = 0x4000000
+
+    __indexFiles: Dict[pathlib.Path, pathlib.Path]
+    __pendingEntries: Dict[pathlib.Path, List]
+
+    def __init__( self, *, db: FileDb.FileDb, target: pathlib.Path, fileTreeIterator: FileDb.FileTreeIterator,
+                  dbPaths: List[pathlib.Path] ):
+        self.__db = db
+        self.__dbPaths = dbPaths
+        self.__target = target
+        self.__fileTreeIterator = fileTreeIterator
+        self.__indexFiles = dict()
+        self.__pendingEntries = dict()
+        self.__mkdirCache = MkDirCache()
+
+    def process( self, filePath: pathlib.Path ):
+        s = filePath.stat()
+        if not stat.S_ISDIR( s.st_mode ):
+            return self.__ingestFile( filePath, pathlib.Path( filePath.name ) )
+
+        success = True
+        for relativePath in self.__fileTreeIterator.iterate( filePath ):
+            if not self.__ingestFile( filePath.joinpath( relativePath ), relativePath ):
+                success = False
+
+        return success
+
+    def commit( self ):
+        pendingEntries = self.__pendingEntries
+        self.__pendingEntries = dict()
+        for indexFile, entries in sorted( pendingEntries.items() ):
+            FileDb.appendIndexEntries( indexFile, entries )
+
+    def __indexSearchPath( self, folder: pathlib.Path ):
+        root = self.__target
+        resolvedFolder = folder.resolve()
+        for dbPath in self.__dbPaths:
+            resolvedDbPath = dbPath.resolve()
+            if resolvedDbPath == resolvedFolder or resolvedDbPath in resolvedFolder.parents:
+                root = dbPath
+                break
+
+        relativePath = resolvedFolder.relative_to( root.resolve() )
+        path = root
+        yield path
+        for part in relativePath.parts:
+            path = path.joinpath( part )
+            yield path
+
+    def __ingestFile( self, sourcePath: pathlib.Path, relativePath: pathlib.Path ):
+        targetPath = self.__target.joinpath( relativePath )
+        indexFile = self.__findIndexFile( targetPath.parent )
+        indexAlgorithm = FileDb.indexFileAlgorithm( indexFile )
+        algorithms = list( self.__db.algorithms )
+        if indexAlgorithm not in algorithms:
+            algorithms.append( indexAlgorithm )
+
+        # файл читается один раз: небольшой в память, большой копируется во временный файл
+        # с одновременным вычислением чек-сумм
+        data = None
+        temporaryPath = None
+        try:
+            if sourcePath.stat().st_size <= self.bufferedFileSize:
+                data, checksums = FileDb.readFileWithChecksums( sourcePath, algorithms )
+            else:
+                self.__mkdirCache.mkdir( self.__target )
+                temporaryPath = makeTemporaryPath( self.__target.joinpath( targetPath.name ) )
+                checksums = FileDb.copyFileWithChecksums( sourcePath, temporaryPath, algorithms )
+
+            if self.__db.findFileByChecksums( relativePath, checksums ) is not None:
+                return True
+
+            self.__mkdirCache.mkdir( targetPath.parent )
+            if targetPath.exists():
+                print( f"skipping {relativePath}, target ({targetPath.name}) already exists" )
+                return False
+
+            if temporaryPath is None:
+                temporaryPath = makeTemporaryPath( targetPath )
+                with temporaryPath.open( mode = 'xb' ) as file:
+                    file.write( data )
+
+                # noinspection PyTypeChecker
+                shutil.copystat( sourcePath, temporaryPath )
+
+            temporaryPath.replace( targetPath )
+            temporaryPath = None
+        finally:
+            if temporaryPath is not None:
+                try:
+                    temporaryPath.unlink()
+                except OSError:
+                    pass
+
+        print( relativePath )
+        checksum = checksums[indexAlgorithm]
+        self.__pendingEntries.setdefault( indexFile, list() ).append(
+            (targetPath.resolve().relative_to( indexFile.parent.resolve() ), checksum) )
+        self.__db.addFile( targetPath, checksum )
+        return True
+
+    def __findIndexFile( self, folder: pathlib.Path ):
+        indexFile = self.__indexFiles.get( folder, None )
+        if indexFile is not None:
+            return indexFile
+
+        # тот же индекс, что и при загрузке базы: верхний на пути от корня базы к папке файла
+        indexFile = None
+        for path in self.__indexSearchPath( folder ):
+            for name in ('Checksums.sha2', 'Checksums.sha1'):
+                if path.joinpath( name ).exists():
+                    indexFile = path.joinpath( name )
+                    break
+
+            if indexFile is not None:
+                break
+
+        if indexFile is None:
+            if self.__target.exists() and \
+                    next( FileDb.iterateIndexFiles( self.__target, pathlib.Path() ), None ) is not None:
+                # новый индекс в целевой папке скрыл бы индексы вложенных папок
+                raise ValueError( f"'{self.__target}' contains indexed folders, but '{folder}' is not covered by index" )
+
+            indexFile = self.__target.joinpath( 'Checksums.sha2' )
+
+        self.__indexFiles[folder] = indexFile
+        return indexFile
 
 
 if __name__ == "__main__":